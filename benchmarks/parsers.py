@@ -0,0 +1,75 @@
+"""Benchmark of the HTML parsing backends on saved pages
+
+Usage (from the repository root):
+    python benchmarks/parsers.py [-n 20]    Compare the backends on the fixture pages
+    python benchmarks/parsers.py --save     Replace the fixtures with live pages
+
+The fixtures shipped in benchmarks/fixtures are synthetic: the markup the bot
+reads, with made up content, wrapped in page chrome of a realistic size, so
+the comparison runs offline and gives the same numbers on every run.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import config as cf
+import httpclient
+import parsing
+from filmaffinity import FilmAffinity
+from futbol import Standings
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+PAGES = {  # fixture -> (url, only the part the bot reads)
+    "search.html": (FilmAffinity.get_search_url(movie="padrino"), parsing.RESULTS),
+    "movie.html": ("https://www.filmaffinity.com/es/film809297.html", parsing.MOVIE),
+    "standings.html": (Standings.get_search_url(), parsing.STANDINGS),
+}
+
+
+def save():
+    """Download every fixture page"""
+    os.makedirs(FIXTURES, exist_ok=True)
+    for name, (url, _) in PAGES.items():
+        response = httpclient.get(url, headers=cf.HEADERS)
+        response.raise_for_status()
+        with open(os.path.join(FIXTURES, name), "w", encoding="utf8") as page:
+            page.write(response.text)
+        print(f"{name}: {len(response.text)} bytes from {url}")
+
+
+def compare(number: int):
+    """Print the milliseconds per parse of every page, backend and mode"""
+    print(f"{'page':<16}{'backend':<13}{'full ms':>9}{'partial ms':>12}")
+    for name, (_, only) in PAGES.items():
+        path = os.path.join(FIXTURES, name)
+        if not os.path.exists(path):
+            print(f"{name:<16}missing, run with --save first")
+            continue
+        with open(path, "r", encoding="utf8") as page:
+            markup = page.read()
+        for backend in parsing.available_backends():
+            full = timeit.timeit(
+                lambda: parsing.make_soup(markup, parser=backend), number=number
+            )
+            partial = timeit.timeit(
+                lambda: parsing.make_soup(markup, only, parser=backend), number=number
+            )
+            print(
+                f"{name:<16}{backend:<13}{full / number * 1000:>9.2f}"
+                f"{partial / number * 1000:>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="download the pages")
+    parser.add_argument("-n", "--number", type=int, default=20, help="parses per case")
+    args = parser.parse_args()
+    if args.save:
+        save()
+    else:
+        compare(args.number)
@@ -0,0 +1,265 @@
+"""Load benchmark of the bot replaying updates against stubbed Telegram and web pages
+
+Usage (from the repository root):
+    python benchmarks/replay.py [-n 200]              Synthetic updates of every command
+    python benchmarks/replay.py --updates rec.jsonl   Recorded updates, one JSON per line
+    python benchmarks/replay.py --webhook             Post them to the webhook instead
+    python benchmarks/replay.py --latency 50 --cold   Slow stubs and no scraping caches
+
+/film and /futbol read the pages of benchmarks/fixtures, and the run stops if
+one is missing or a command asks for a page that has no fixture.
+The lists live in a temporary directory, so the real ones are not touched.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from itertools import count
+
+import requests
+from requests.adapters import BaseAdapter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import config as cf
+from telebot import apihelper
+
+PAGES = {  # part of the url -> fixture
+    "advsearch.php": "search.html",
+    "/film": "movie.html",
+    "as.com": "standings.html",
+}
+COMMANDS = ("/list", "/find", "/add", "/film", "/futbol")
+LIST_SIZE = 2000  # Items of the synthetic lists
+
+
+class FixtureAdapter(BaseAdapter):
+    """Answer the requests of httpclient with the saved pages"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        time.sleep(self.latency)
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        name = next((page for part, page in PAGES.items() if part in request.url), None)
+        if name is None:  # Timing an error page would measure the wrong path
+            raise RuntimeError(f"No fixture for {request.url}")
+        response.status_code = 200
+        response.reason = "OK"
+        with open(os.path.join(FIXTURES, name), "rb") as page:
+            response._content = page.read()  # pylint: disable=protected-access
+        return response
+
+    def close(self):
+        pass
+
+
+class TelegramStub:
+    """Answer the Bot API calls as Telegram would, counting them"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._ids = count(1)
+
+    def __call__(self, method, url, params=None, **kwargs):
+        time.sleep(self.latency)
+        self.calls += 1
+        params = params or {}
+        api_method = url.rsplit("/", 1)[-1]
+        if api_method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": params.get("message_id") or next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif api_method == "getChat":
+            result = {"id": int(params.get("chat_id", 0)), "type": "private"}
+        else:
+            result = True
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(  # pylint: disable=protected-access
+            {"ok": True, "result": result}
+        ).encode()
+        return response
+
+
+def message_update(update_id: int, text: str) -> dict:
+    """Return the JSON of an update with a message of a nene"""
+    chat = {"id": cf.NENE_ID, "type": "private"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": cf.NENE_ID, "is_bot": False, "first_name": "Nene"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+def synthetic(number: int) -> list:
+    """Return 'number' updates of every command"""
+    texts = {
+        "/list": lambda i: "/list -m",
+        "/find": lambda i: f"/find -m peli {i % LIST_SIZE}",
+        "/add": lambda i: f"/add -mt Peli nueva {i}",
+        "/film": lambda i: f"/film padrino {i}",
+        "/futbol": lambda i: "/futbol clasi",
+    }
+    ids = count(1)
+    return [
+        message_update(next(ids), text(i)) for text in texts.values() for i in range(number)
+    ]
+
+
+def recorded(path: str) -> list:
+    """Return the updates saved in a file, one JSON per line"""
+    with open(path, "r", encoding="utf8") as lines:
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+def command_of(update: dict) -> str:
+    """Return the command of an update, 'other' if it has none"""
+    message = update.get("message") or {}
+    text = message.get("text") or ""
+    return text.split()[0] if text.startswith("/") else "other"
+
+
+def prepare(latency: float):
+    """Stub Telegram and the web, set the bot to run every update inline and
+    move to a temporary directory with synthetic lists.
+    Return the bot module and that directory."""
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    os.makedirs(os.path.join(workdir, "files"))
+    for file in set(cf.LISTS):
+        with open(os.path.join(workdir, file), "w", encoding="utf8") as lst:
+            lst.writelines(f"Peli {i} de prueba\n" for i in range(LIST_SIZE))
+    os.chdir(workdir)
+
+    cf.ASYNC_COMMANDS = False  # Wait for the commands to time them
+    cf.OUTBOX["enabled"] = False  # Send each call right away to the stub
+    cf.PREFETCH["enabled"] = False
+    cf.STATE["path"] = None
+    apihelper.CUSTOM_REQUEST_SENDER = TelegramStub(latency)
+
+    import httpclient  # pylint: disable=import-outside-toplevel
+    import main  # pylint: disable=import-outside-toplevel
+
+    httpclient._session.mount("https://", FixtureAdapter(latency))  # pylint: disable=protected-access
+    main.bot.threaded = False
+    main.bot.add_custom_filter(main.AreNenes())
+    return main, workdir
+
+
+def percentile(values: list, pct: float) -> float:
+    """Return a percentile of the values"""
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def replay(main, updates: list, cold: bool) -> dict:
+    """Process the updates one by one and return the seconds of each command"""
+    import filmaffinity  # pylint: disable=import-outside-toplevel
+    import futbol  # pylint: disable=import-outside-toplevel
+    import telebot  # pylint: disable=import-outside-toplevel
+
+    times = {}
+    for raw in updates:
+        if cold:
+            filmaffinity.SEARCHES.clear()
+            futbol.STANDINGS.clear()
+        update = telebot.types.Update.de_json(json.dumps(raw))
+        start = time.perf_counter()
+        main.bot.process_new_updates([update])
+        times.setdefault(command_of(raw), []).append(time.perf_counter() - start)
+    return times
+
+
+def replay_webhook(main, updates: list) -> tuple:
+    """Post the updates to the webhook and wait for the workers to handle them.
+    The time of an update goes from its first post until its handler finished,
+    so it includes the retries of a refused post and the wait in the queue.
+    Return the seconds of each update and the seconds until all were done."""
+    client = main.web_server.test_client()
+    posted, handled = {}, {}
+    process = main.UPDATES.process
+
+    def timed_process(batch):
+        try:
+            process(batch)
+        finally:
+            for update in batch:
+                handled[update.update_id] = time.perf_counter()
+
+    main.UPDATES.process = timed_process
+    start = time.perf_counter()
+    for raw in updates:
+        posted[raw["update_id"]] = time.perf_counter()
+        while client.post("/", json=raw).status_code == 503:
+            time.sleep(0.005)
+    while len(handled) < len(posted):
+        time.sleep(0.01)
+    total = time.perf_counter() - start
+
+    times = {}
+    for raw in updates:
+        update_id = raw["update_id"]
+        times.setdefault(command_of(raw), []).append(handled[update_id] - posted[update_id])
+    return times, total
+
+
+def report(times: dict):
+    """Print p50/p99 latency and updates per second of every command"""
+    print(f"{'command':<10}{'updates':>8}{'p50 ms':>10}{'p99 ms':>10}{'updates/s':>11}")
+    for command in sorted(times, key=lambda c: COMMANDS.index(c) if c in COMMANDS else 99):
+        spent = times[command]
+        print(
+            f"{command:<10}{len(spent):>8}{percentile(spent, 50) * 1000:>10.2f}"
+            f"{percentile(spent, 99) * 1000:>10.2f}{len(spent) / sum(spent):>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=200, help="updates per command")
+    parser.add_argument("--updates", help="file with recorded updates, one JSON per line")
+    parser.add_argument("--webhook", action="store_true", help="post to the webhook")
+    parser.add_argument("--latency", type=float, default=0, help="ms of every stub call")
+    parser.add_argument("--cold", action="store_true", help="clear scraping caches before each update (not with --webhook)")
+    args = parser.parse_args()
+
+    missing = [page for page in PAGES.values() if not os.path.exists(os.path.join(FIXTURES, page))]
+    if missing:
+        sys.exit(f"Missing fixtures {', '.join(missing)} in {FIXTURES}")
+
+    UPDATES = recorded(os.path.abspath(args.updates)) if args.updates else synthetic(args.number)
+    BOT, WORKDIR = prepare(args.latency / 1000)
+    try:
+        if args.webhook:
+            TIMES, TOTAL = replay_webhook(BOT, UPDATES)
+            print("Latency from the first post of an update until its handler finished")
+            report(TIMES)
+            print(f"\n{len(UPDATES)} updates processed in {TOTAL:.2f}s "
+                  f"({len(UPDATES) / TOTAL:.1f} updates/s), queue: {BOT.UPDATES.stats}")
+        else:
+            report(replay(BOT, UPDATES, args.cold))
+        print(f"Telegram calls: {apihelper.CUSTOM_REQUEST_SENDER.calls}")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -0,0 +1,93 @@
+"""Stress check of concurrent /add on a list store
+
+Usage (from the repository root):
+    python benchmarks/stress_add.py [-n 300] [--readers 50]
+
+Fires 'n' adds from as many threads while readers list and search the same
+store, then checks that the positions returned are exactly 1..n, that the
+store holds every title once in that order, and that a failing operation in
+a batch fails the whole batch instead of leaving jobs without a result.
+The store lives in a temporary directory.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import filetreatment as ft
+from liststore import ListStore
+
+
+def stress(number: int, readers: int, file: str) -> float:
+    """Add 'number' titles at once and check the numbering. Return the seconds spent."""
+    positions = {}
+    errors = []
+    start_line = threading.Barrier(number + readers)
+    stop = threading.Event()
+
+    def add(i):
+        start_line.wait()
+        try:
+            positions[i] = ft.add(file, f"Peli {i}")
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    def read():
+        start_line.wait()
+        while not stop.is_set():
+            ft.len_(file)
+            ft.find_last(file)
+            ft.find_(file, ["peli"])
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(number)]
+    watchers = [threading.Thread(target=read) for _ in range(readers)]
+    begin = time.perf_counter()
+    for thread in threads + watchers:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    spent = time.perf_counter() - begin
+    stop.set()
+    for thread in watchers:
+        thread.join()
+
+    assert not errors, errors
+    assert sorted(positions.values()) == list(range(1, number + 1)), "positions not 1..n"
+    titles = [text.split("--- ", 1)[1].rstrip("\n") for text in ft.list_(file)]
+    assert len(titles) == number == ft.len_(file)
+    assert all(titles[pos - 1] == f"Peli {i}" for i, pos in positions.items())
+    return spent
+
+
+def failing_batch(directory: str):
+    """Check that an unexpected error in a batched operation fails every job"""
+    store = ListStore(os.path.join(directory, "batch.db"))
+    jobs = [
+        {"operation": lambda conn, _: conn.execute("INSERT INTO items (title) VALUES ('a')")},
+        {"operation": lambda conn, _: 1 / 0},
+        {"operation": lambda conn, _: conn.execute("INSERT INTO items (title) VALUES ('b')")},
+    ]
+    with store._lock.write():  # pylint: disable=protected-access
+        store._commit(jobs)  # pylint: disable=protected-access
+    assert all("error" in job and "result" not in job for job in jobs), jobs
+    assert store.count() == 0, "the failed batch was not rolled back"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=300, help="concurrent adds")
+    parser.add_argument("--readers", type=int, default=50, help="concurrent readers")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "stress.txt")
+        open(path, "w", encoding="utf8").close()
+        SPENT = stress(args.number, args.readers, path)
+        failing_batch(workdir)
+    print(f"{args.number} concurrent adds with {args.readers} readers: "
+          f"positions 1..{args.number}, no duplicates ({SPENT:.2f}s)")
@@ -0,0 +1,215 @@
+"""Caches for data that is expensive to get again"""
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache:
+    """In-memory cache with expiry that forgets the least recently used entry"""
+
+    def __init__(self, max_entries: int, ttl: float = None, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict  # Called with (key, value) of evicted entries
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._loading = {}  # key -> Future of the load in flight
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value of a key, 'default' if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, ttl: float = None):
+        """Save a value, with its own time to live if given"""
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        evicted = []
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False))
+        if self.on_evict is not None:
+            now = time.monotonic()
+            for old_key, (old_expires, old_value) in evicted:
+                if old_expires is None or old_expires >= now:
+                    self.on_evict(old_key, old_value)
+
+    def get_or_load(self, key, loader, ttl: float = None):
+        """Return the value of a key calling 'loader' on a miss.
+
+        Concurrent misses of the same key wait for the first load instead of
+        repeating it. Errors are passed to every waiter and are not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            flight = self._loading.get(key)
+            first = flight is None
+            if first:
+                flight = self._loading[key] = Future()
+        if not first:
+            return flight.result()
+
+        try:
+            value = loader()
+        except BaseException as error:
+            flight.set_exception(error)
+            raise
+        else:
+            self.put(key, value, ttl)
+            flight.set_result(value)
+        finally:
+            with self._lock:
+                del self._loading[key]
+        return value
+
+    def pop(self, key, default=None):
+        """Remove a key and return its value"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """Remove every entry"""
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache:
+    """SQLite cache of JSON values with expiry and least recently used eviction"""
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, stored REAL NOT NULL, used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        """Return the value of a key, None if missing or expired"""
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value, stored FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl < now:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def delete(self, key: str):
+        """Remove a key"""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def put(self, key: str, value):
+        """Save a value and evict the least used entries over the limit"""
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            extra = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            extra -= self.max_entries
+            if extra > 0:
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY used LIMIT ?)",
+                    (extra,),
+                )
+
+    def purge(self) -> int:
+        """Remove expired entries and those over the limit, then give the space
+        back to the file system. Return the bytes reclaimed."""
+        before = self.size()
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache WHERE stored < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM cache WHERE key NOT IN "
+                "(SELECT key FROM cache ORDER BY used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return max(before - self.size(), 0)
+
+    def size(self) -> int:
+        """Return the bytes used by the database and its journal"""
+        size = 0
+        for path in (self.path, f"{self.path}-wal"):
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        return size
+
+
+class RecordCache:
+    """Cache of dataclass records with a hot tier in memory in front of the disk"""
+
+    def __init__(self, record, path, ttl, max_entries, hot_entries):
+        self.record = record
+        self.hot = LRUCache(hot_entries, ttl)
+        self.disk = DiskCache(path, ttl, max_entries)
+
+    def get(self, key: str):
+        """Return the record of a key, None if it is not cached"""
+        found = self.hot.get(key)
+        if found is None:
+            value = self.disk.get(key)
+            if value is not None:
+                found = self.record(**value)
+                self.hot.put(key, found)
+        return found
+
+    def put(self, key: str, found):
+        """Save a record in both tiers"""
+        self.hot.put(key, found)
+        self.disk.put(key, dataclasses.asdict(found))
+
+    def get_or_load(self, key: str, loader):
+        """Return the record of a key, calling 'loader' once if it is not cached"""
+
+        def load():
+            value = self.disk.get(key)
+            if value is not None:
+                return self.record(**value)
+            found = loader()
+            self.disk.put(key, dataclasses.asdict(found))
+            return found
+
+        return self.hot.get_or_load(key, load)
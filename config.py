@@ -8,11 +8,17 @@ MOVIES = "./files/examplefile.txt"
 MOVIES_TO_SEE = "./files/examplefile.txt"
 SERIES = "./files/series.txt"
 SERIES_TO_SEE = "./files/examplefile.txt"
+LISTS = (MOVIES, MOVIES_TO_SEE, SERIES, SERIES_TO_SEE)
+COMPACT_EVERY = 100  # Cambios en una lista antes de volcarlos al fichero de texto
 
 NENE_ID = 0
 NENA_ID = 0
 PRUEBA_GROUP_ID = -0
 PETENOS_GROUP_ID = -0
+VERIFY_CHATS_TTL = None  # Segundos que vale comprobar el chat con Telegram (None: no)
+
+N_RES_FIND = 10  # Maximo de resultados aproximados de /find
+MAX_RES_FIND = 40  # Maximo de resultados exactos de /find en un mensaje
 
 
 # Web-scrapping constants
@@ -22,6 +28,67 @@ HEADERS = {
     "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/101.0.4951.64 Safari/537.36 Edg/101.0.1210.53"
 }
 
+HTTP = {
+    "hosts": 10,  # Hosts con conexiones guardadas
+    "per_host": 4,  # Conexiones (y peticiones a la vez) por host
+    "background_per_host": 2,  # Aparte, para el prefetch (sin reintentos)
+    "retries": 3,  # Reintentos si responde 5xx o falla la conexión (un 429 no)
+    "backoff": 0.5,  # Espera entre reintentos: 0.5s, 1s, 2s...
+    "timeout": 10,
+}
+
+STANDINGS_TTL = {"matchday": 300, "rest": 6 * 3600}  # Segundos de la clasificación
+MATCHDAYS = (4, 5, 6, 0)  # Días con partidos (viernes a lunes)
+MATCH_HOUR = 12  # Hora desde la que hay partidos
+
+HTML_PARSER = "auto"  # "lxml", "html.parser" o "auto" (el más rápido instalado)
+
+ASYNC_COMMANDS = True  # /film y /futbol no bloquean al bot mientras descargan
+PIPELINE_WORKERS = 8  # Hilos para descargas y parseo de esos comandos
+PREFETCH = {  # Descarga de las pelis de la página vista
+    "enabled": True,
+    "workers": 3,
+    "backoff": 60,  # Segundos sin descargar si FilmAffinity responde 429 (se dobla si repite)
+    "max_backoff": 30 * 60,
+}
+WEBHOOK = {  # Cola de updates que llegan por el webhook
+    "max_size": 256,  # Updates esperando (llena: Telegram los reenvía luego)
+    "workers": 4,
+    "dedup": 1000,  # Últimos update_id recordados para no repetirlos
+}
+OUTBOX = {  # Cola de mensajes a Telegram (enabled False: se envían al momento)
+    "enabled": True,
+    "rate": 30,  # Mensajes por segundo en total
+    "chat_rate": 1,  # Mensajes por segundo a un mismo chat privado
+    "group_rate": 20 / 60,  # Mensajes por segundo a un mismo grupo
+    "chat_burst": 5,  # Mensajes seguidos a un chat antes de esperar
+    "workers": 4,
+}
+
 N_RES_PAG = 5  # Numero de resultados en cada pagina
+N_LIST_PAG = 30  # Pelis/series en cada pagina de /list (un mensaje tiene 4096 caracteres)
 MAX_WIDTH_ROW = 8  # Maximo en telegram es 8
-DIR = {"searches": "./searches/"}  # where to save searched files
+DIR = {"searches": "./searches/", "cache": "./cache/"}  # where to save searched files
+SESSIONS = {  # Páginas de los resultados de /film
+    "max_entries": 500,  # Búsquedas en memoria
+    "ttl": 2 * 24 * 3600,  # Segundos hasta que caduca una búsqueda
+    "spill": "./searches/sessions.db",  # Donde van las que no caben (None: se olvidan)
+    "spill_entries": 5000,
+}
+JANITOR_INTERVAL = 6 * 3600  # Segundos entre limpiezas de la carpeta de búsquedas
+DETAIL_CACHE = {
+    "path": "./cache/movies.db",
+    "ttl": 7 * 24 * 3600,  # Segundos que se guarda una peli
+    "max_entries": 5000,  # Pelis en disco
+    "hot_entries": 200,  # Pelis en memoria
+}
+SEARCH_CACHE = {"ttl": 300, "max_entries": 256}  # Búsquedas de /film en memoria
+METRICS = {  # Tiempos y contadores que se ven en /metrics
+    "enabled": True,
+    "trace": None,  # Fichero donde escribir los tiempos de cada petición (None: no)
+    "token": None,  # Clave que pide /metrics en 'Authorization: Bearer' (None: sin /metrics)
+}
+STATE = {  # Conversaciones con botones de cada chat
+    "ttl": 30 * 60,  # Segundos sin respuesta hasta que caduca
+    "path": None,  # Fichero donde se guardan para sobrevivir reinicios (None: en memoria)
+}
@@ -1,115 +1,147 @@
 """Methods for file treatment"""
-import re
+import heapq
+import os
 from collections import deque
 
+from liststore import open_store
+from metrics import span, timed
 
-def read_file(func):
-    """Decorator for reading the file"""
+
+def use_store(func):
+    """Decorator for working with the store of the file"""
 
     def a_wrapper(file, *args):
-        with open(file, "r", encoding="utf8") as file:  # type: ignore
-            return func(file, *args)
+        with span("filetreatment", func=func.__name__):
+            return func(open_store(file), *args)
 
     return a_wrapper
 
 
-def append_file(func):
-    """Decorator for writing the file"""
+def line(pos: int, text: str) -> str:
+    """Return the line shown for an item"""
+    return f"{pos:03d}--- {text}\n"
 
-    def a_wrapper(file, *args):
-        with open(file, "a", encoding="utf8") as file:
-            return func(file, *args)
 
-    return a_wrapper
+@use_store
+def len_(store):
+    """Function that returns the length of the file"""
+    return store.count()
 
 
-def read_write_file(func):
-    """Decorator for r/w the file"""
+@use_store
+def list_(store):
+    """Function that lists for any file"""
+    return [line(pos, text) for pos, text in enumerate(store.titles(), 1)]
 
-    def a_wrapper(file, *args):
-        with open(file, "r+", encoding="utf8") as file:
-            return func(file, *args)
 
-    return a_wrapper
+@use_store
+def list_page(store, pag: int, size: int):
+    """Function that returns a page of any file and the length of the file"""
+    return [line(pos, text) for pos, text in store.page(pag * size + 1, size)], store.count()
 
 
-@read_file
-def len_(file):
-    """Function that returns the length of the file"""
-    return sum(1 for line in file)
+@use_store
+def find_(store, req):
+    """Function that finds movie/serie requested"""
+    return [line(pos, text) for pos, text in store.search(" ".join(req))]
 
 
-@read_file
-def list_(file):
-    """Function that lists for any file"""
-    list_return = file.readlines()
-    return list_return
+@use_store
+def find_fuzzy(store, req, limit):
+    """Function that finds the movies/series most similar to the requested one"""
+    return [
+        f"{line(pos, text)[:-1]}   ({score:.0%})\n"
+        for score, pos, text in store.fuzzy_search(" ".join(req), limit)
+    ]
 
 
-@read_file
-def find_(file, req):
-    """Function that finds movie/serie requested"""
+@timed("filetreatment")
+def find_all(files, req):
+    """Function that finds movie/serie requested in every list"""
     found_list = []
-    for line in file:
-        if re.search(" ".join(str(i) for i in req), line, flags=re.IGNORECASE):
-            found_list.append(line)
+    for file, store in stores(files).items():
+        tag = which_file(file).capitalize().replace("_", " ")
+        found_list.extend(
+            f"[{tag}] {line(pos, text)}" for pos, text in store.search(" ".join(req))
+        )
     return found_list
 
 
-@read_file
-def find_last(file):
+@timed("filetreatment")
+def find_fuzzy_all(files, req, limit):
+    """Function that finds the most similar movies/series in every list"""
+    scored = []
+    for file, store in stores(files).items():
+        tag = which_file(file).capitalize().replace("_", " ")
+        scored.extend(
+            (score, f"[{tag}] {line(pos, text)[:-1]}   ({score:.0%})\n")
+            for score, pos, text in store.fuzzy_search(" ".join(req), limit)
+        )
+    return [text for _, text in heapq.nlargest(limit, scored, key=lambda x: x[0])]
+
+
+def stores(files) -> dict:
+    """Return the store of every file, only once if several files are the same"""
+    found = {}
+    for file in files:
+        store = open_store(file)
+        if store not in found.values():
+            found[file] = store
+    return found
+
+
+@use_store
+def find_last(store):
     """Function that returns las 10 movies/series"""
-    return deque(file, 10)
+    return deque((line(pos, text) for pos, text in store.tail(10)), 10)
 
 
-@read_file
-def find_pos(file, pos):
+@use_store
+def find_pos(store, pos):
     """Function that finds movie/serie given a position"""
-    lines = file.readlines()
-    return (pos, lines[pos - 1][6:])
+    return (pos, f"{store.get(pos)}\n")
+
+
+@use_store
+def add(store, text, pos=None):  # pylint: disable=unused-argument
+    """Function that adds movie/serie requested and returns its position"""
+    return store.append(text)
 
 
-@append_file
-def add(file, text, pos):
-    """Function that adds movie/serie requested"""
-    file.write(f"{pos:03d}--- {text}\n")
+@use_store
+def add_many(store, texts):
+    """Function that adds several movies/series and returns their positions"""
+    first = store.append_many(texts)
+    return [(first + i, text) for i, text in enumerate(texts)]
 
 
-@read_write_file
-def edit(file, text, pos: int):
+@use_store
+def edit(store, text, pos: int):
     """Function that edit in any file"""
-    lines = file.readlines()
-    lines[pos - 1] = f"{pos:03d}--- {text}\n"
-    file.seek(0)
-    file.truncate()
-    file.writelines(lines)
+    store.update(pos, text)
 
 
-@read_write_file
-def del_(file, pos: int):
-    """Function that delete in any file by position"""
-    lines = file.readlines()
-    lines.pop(pos - 1)
+@use_store
+def del_(store, pos: int):
+    """Function that delete in any file by position and returns what it was"""
+    return (pos, f"{store.delete(pos)}\n")
 
-    for i, txt in enumerate(lines[pos - 1 :]):
-        lines[i + pos - 1] = f"{i+pos:03d}{txt[3:]}"
 
-    file.seek(0)
-    file.truncate()
-    file.writelines(lines)
+@use_store
+def del_many(store, positions):
+    """Function that deletes several positions and returns what they were"""
+    return [
+        (pos, f"{text}\n") for pos, text in zip(positions, store.delete_many(positions))
+    ]
 
 
-@read_write_file
-def del_last(file):
-    """Function that delete the last item in any file"""
-    lines = file.readlines()
-    lines.pop()
-    file.seek(0)
-    file.truncate()
-    file.writelines(lines)
+@use_store
+def del_last(store):
+    """Function that delete the last item in any file and returns what it was"""
+    pos, text = store.delete_last()
+    return (pos, f"{text}\n")
 
 
 def which_file(filename) -> str:
     """Function that returns the worked file"""
-    name = re.split(r"\/|\.", filename)
-    return name[4].upper()
+    return os.path.splitext(os.path.basename(filename))[0].upper()
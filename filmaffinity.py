@@ -1,8 +1,97 @@
 """Module for managing Film Affinity web scrapping"""
+import re
 from dataclasses import dataclass, field
 
-import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+import config as cf
+import httpclient
+import parsing
+from cache import LRUCache, RecordCache
+from parsing import make_soup
+
+
+CREDITS = {"Guion": "script", "Música": "music", "Fotografía": "photo"}
+
+
+@dataclass(frozen=True, slots=True)
+class Movie:
+    """Record with the data of a movie"""
+
+    title: str = "-"
+    year: str = "-"
+    duration: str = "- min."
+    rating: str = "-"
+    country: str = "-"
+    director: str = "-"
+    script: str = "-"
+    music: str = "-"
+    photo: str = "-"
+    actors: str = "-"
+    producer: str = "-"
+    genre: str = "-"
+    synopsis: str = "-"
+
+    def __str__(self) -> str:
+        string = (
+            f"<b>[{self.rating}]</b> <b><i>{self.title}</i></b> <code>({self.duration} {self.year}-{self.country})</code>"
+            f"\n\n<code>Dirección:</code>     <b>{self.director}</b>"
+            f"\n\n<code>Reparto:</code>     <b>{self.actors}</b>"
+            f"\n\n<code>Sinopsis:</code>     <b>{self.synopsis}</b>"
+            f"\n\nOtros datos:"
+            f"\n     <code>Género:</code>     <b>{self.genre}</b>"
+            f"\n     <code>Guión:</code>     <b>{self.script}</b>"
+            f"\n     <code>Música:</code>     <b>{self.music}</b>"
+            f"\n     <code>Fotografía:</code>     <b>{self.photo}</b>"
+            f"\n     <code>Productora:</code>     <b>{self.producer}</b>"
+        )
+        return string
+
+
+def parse_movie(soup: BeautifulSoup) -> Movie:
+    """Extract the movie walking the movie-info <dl> only once"""
+    fields = {}
+    tag = soup.find("h1", id="main-title")
+    if tag is not None:
+        fields["title"] = (tag.find("span") or tag).text.strip()
+    tag = soup.find("div", id="movie-rat-avg")
+    if tag is not None:
+        fields["rating"] = tag.text.strip()
+
+    info = soup.find("dl", class_="movie-info") or soup
+    label = ""
+    for tag in info.find_all(["dt", "dd"], recursive=info is not soup):
+        if tag.name == "dt":
+            label = tag.text.strip()
+            continue
+
+        itemprop = tag.get("itemprop")
+        if itemprop == "datePublished":
+            fields["year"] = tag.text
+        elif itemprop == "duration":
+            fields["duration"] = tag.text.strip()
+        elif itemprop == "description":
+            fields["synopsis"] = tag.text.strip()
+        elif "card-producer" in tag.get("class", ()):
+            fields["producer"] = tag.text.strip()
+        elif label == "Reparto":
+            fields["actors"] = tag.text.strip()
+        elif label in CREDITS:
+            fields[CREDITS[label]] = tag.text.strip()
+
+        country = tag.find("span", id="country-img")
+        if country is not None and country.find("img") is not None:
+            fields["country"] = country.find("img").attrs.get("alt", "-").strip()
+        if "director" not in fields:
+            director = tag.find("a", itemprop="url")
+            if director is not None:
+                fields["director"] = director.text.strip()
+        if "genre" not in fields:
+            genre = tag.find("span", itemprop="genre")
+            if genre is not None:
+                fields["genre"] = genre.text.strip()
+
+    return Movie(**fields)
 
 
 @dataclass
@@ -10,142 +99,76 @@ class FilmAffinity:
     """Class to create object with all the data"""
 
     _soup: BeautifulSoup = field(repr=False)
-    _mov_title: str = None
-    _year: str = None
-    _duration: str = None
-    _rating: str = None
-    _country: str = None
-    _director: str = None
-    _credits: dict = field(default_factory=dict)
-    _actors: str = None
-    _producer: str = None
-    _genre: str = None
-    _synopsis: str = None
+    _movie: Movie = field(default=None, init=False)
+
+    @property
+    def movie(self) -> Movie:
+        """Return the record with every field, parsed the first time"""
+        if self._movie is None:
+            self._movie = parse_movie(self._soup)
+        return self._movie
 
     @property
     def mov_title(self):
         """Return title"""
-        return self._soup.find("h1", id="main-title").find("span").text.strip()
+        return self.movie.title
 
     @property
     def year(self):
         """Return year"""
-        return self._soup.find("dd", itemprop="datePublished").text
+        return self.movie.year
 
     @property
     def duration(self):
         """Return duration"""
-        tag = self._soup.find("dd", itemprop="duration")
-        if tag is None:
-            return "- min."
-        return tag.text.strip()
+        return self.movie.duration
 
     @property
     def rating(self):
         """Return rating"""
-        tag = self._soup.find("div", id="movie-rat-avg")
-        if tag is None:
-            return "-"
-        return tag.text.strip()
+        return self.movie.rating
 
     @property
     def country(self):
         """Return country"""
-        tag = self._soup.find("span", id="country-img").find("img").attrs["alt"]
-        if tag is None:
-            return "-"
-        return tag.strip()
+        return self.movie.country
 
     @property
     def director(self):
         """Return director"""
-        tag = self._soup.find("a", itemprop="url")
-        if tag is None:
-            return "-"
-        return tag.text.strip()
+        return self.movie.director
 
     @property
     def credits(self):
         """Return dict of script, music and photo"""
-        dict_credits = {}
-        credit = self._soup.dd
-        while credit is not None:
-            pre_tag = credit.find_previous_sibling("dt")
-
-            if pre_tag.text.strip() == "Guion":
-                dict_credits["Guion"] = credit.text.strip()
-            if pre_tag.text.strip() == "Música":
-                dict_credits["Musica"] = credit.text.strip()
-            if pre_tag.text.strip() == "Fotografía":
-                dict_credits["Fotografía"] = credit.text.strip()
-
-            credit = credit.find_next_sibling("dd")
-
-        if "Guion" not in dict_credits:
-            dict_credits["Guion"] = "-"
-        if "Musica" not in dict_credits:
-            dict_credits["Musica"] = "-"
-        if "Fotografía" not in dict_credits:
-            dict_credits["Fotografía"] = "-"
-
-        return dict_credits
+        return {
+            "Guion": self.movie.script,
+            "Musica": self.movie.music,
+            "Fotografía": self.movie.photo,
+        }
 
     @property
     def actors(self):
         """Return list of actors"""
-        credit = self._soup.dd
-        while credit is not None:
-            pre_tag = credit.find_previous_sibling("dt")
-
-            if pre_tag.text.strip() == "Reparto":
-                str_actors = credit.text.strip()
-
-            credit = credit.find_next_sibling("dd")
-        return str_actors
+        return self.movie.actors
 
     @property
     def producer(self):
         """Return producer"""
-        tag = self._soup.find("dd", class_="card-producer")
-        if tag is None:
-            return "-"
-        return tag.text.strip()
+        return self.movie.producer
 
     @property
     def genre(self):
         """Return genre"""
-        tag = self._soup.find("span", itemprop="genre")
-        if tag is None:
-            return "-"
-        return tag.text.strip()
+        return self.movie.genre
 
     @property
     def synopsis(self):
         """Return synopsis"""
-        tag = self._soup.find("dd", itemprop="description")
-        if tag is None:
-            return "-"
-        return tag.text.strip()
+        return self.movie.synopsis
 
     def __str__(self) -> str:
-        dict_credits = self.credits
-        scripter = dict_credits["Guion"]
-        music = dict_credits["Musica"]
-        photo = dict_credits["Fotografía"]
-
-        string = (
-            f"<b>[{self.rating}]</b> <b><i>{self.mov_title}</i></b> <code>({self.duration} {self.year}-{self.country})</code>"
-            f"\n\n<code>Dirección:</code>     <b>{self.director}</b>"
-            f"\n\n<code>Reparto:</code>     <b>{self.actors}</b>"
-            f"\n\n<code>Sinopsis:</code>     <b>{self.synopsis}</b>"
-            f"\n\nOtros datos:"
-            f"\n     <code>Género:</code>     <b>{self.genre}</b>"
-            f"\n     <code>Guión:</code>     <b>{scripter}</b>"
-            f"\n     <code>Música:</code>     <b>{music}</b>"
-            f"\n     <code>Fotografía:</code>     <b>{photo}</b>"
-            f"\n     <code>Productora:</code>     <b>{self.producer}</b>"
-        )
-        return string
+        return str(self.movie)
 
     @staticmethod
     def get_search_url(
@@ -161,12 +184,84 @@ class FilmAffinity:
         return search_url
 
     @staticmethod
-    def get_soup(page: str, head: dict) -> BeautifulSoup:
-        """Method to get the soup for a page"""
-        _req = requests.get(url=page, headers=head, timeout=10)
-        _soup = BeautifulSoup(_req.text, "html.parser")
+    def get_soup(page: str, head: dict, only: SoupStrainer = None) -> BeautifulSoup:
+        """Method to get the soup for a page, only some parts if 'only' is given"""
+        _req = httpclient.get(page, headers=head)
+        _req.raise_for_status()
+        _soup = make_soup(_req.text, only)
         return _soup
 
+    @staticmethod
+    def search(film_args: dict, head: dict) -> list:
+        """Method to get the [id, year, title, link] results of a search, sharing
+        the request with identical searches made at the same time"""
+        return SEARCHES.get_or_load(
+            search_key(film_args), lambda: FilmAffinity.get_results(film_args, head)
+        )
+
+    @staticmethod
+    def get_results(film_args: dict, head: dict) -> list:
+        """Method to download and parse the results of a search"""
+        url = FilmAffinity.get_search_url(
+            movie=film_args["movie"],
+            fromyear=film_args["fromyear"],
+            toyear=film_args["toyear"],
+            country=film_args["country"],
+            genre=GENRES[film_args["genre"]] if GENRES.get(film_args["genre"]) else "",
+            orderby=film_args["orderby"],
+        )
+        _req = httpclient.get(url, headers=head)
+        _req.raise_for_status()
+        soup = make_soup(_req.text, parsing.RESULTS)  # No results, no divs
+
+        elements_list = []
+        for i, element in enumerate(soup.find_all("div", class_="mc-title")):
+            try:
+                id_ = i + 1
+                year = element.text[-6:].strip().split(")")[0]
+                title = element.find("a").attrs["title"].strip()
+                link = element.find("a").attrs["href"].strip()
+
+                if [str(id_), year, title, link] in elements_list:
+                    continue
+                elements_list.append([str(id_), year, title, link])
+            except IndexError:
+                continue
+        return elements_list
+
+    @staticmethod
+    def get_movie(page: str, head: dict) -> Movie:
+        """Method to get the movie of a page, from the cache if it is there and
+        sharing the download with whoever is getting it at the same time"""
+        return MOVIES.get_or_load(movie_key(page), lambda: FilmAffinity.load_movie(page, head))
+
+    @staticmethod
+    def load_movie(page: str, head: dict) -> Movie:
+        """Method to download and parse a movie page, raising ValueError if the
+        page has no movie so that it is never cached"""
+        movie = parse_movie(FilmAffinity.get_soup(page=page, head=head, only=parsing.MOVIE))
+        if movie.title in ("", "-"):  # Error or captcha page
+            raise ValueError(f"No movie in {page}")
+        return movie
+
+
+def search_key(film_args: dict) -> tuple:
+    """Return the same key for searches that only differ in case or spaces"""
+    return tuple(
+        (arg, " ".join(str(value).lower().split()))
+        for arg, value in sorted(film_args.items())
+    )
+
+
+def movie_key(page: str) -> str:
+    """Return the FilmAffinity id of a movie page, or the page if there is none"""
+    found = re.search(r"film(\d+)\.html", page)
+    return found.group(1) if found else page
+
+
+MOVIES = RecordCache(Movie, **cf.DETAIL_CACHE)  # Movies already parsed
+SEARCHES = LRUCache(**cf.SEARCH_CACHE)  # Results of the last searches
+
 
 GENRES = {
     "": "",
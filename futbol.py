@@ -2,10 +2,16 @@
 # pylint: disable=invalid-name
 
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 
-import requests
 from bs4 import BeautifulSoup
 
+import config as cf
+import httpclient
+import parsing
+from cache import LRUCache
+from parsing import make_soup
+
 NAMES = {
     "Real Madrid": "RMA",
     "Barcelona": "FCB",
@@ -43,6 +49,9 @@ class Standings:
     def teams(self):
         """Return list of team"""
 
+        if self._teams:  # Already parsed
+            return self._teams
+
         data = ["pts", "pj", "pg", "pe", "pp", "gf", "gc"]
         elements = self._soup.find_all(
             "th",
@@ -54,9 +63,9 @@ class Standings:
             name_team = ele.find("span", itemprop="name").text.strip()
             if NAMES.get(name_team):
                 name_team = NAMES[name_team]
-            elements_data = ele.find_all_next("td")
+            elements_data = ele.find_next_siblings("td", limit=7)  # Same row only
             self._teams[i + 1] = {"team": name_team}
-            for j, ele_data in enumerate(elements_data[:7]):
+            for j, ele_data in enumerate(elements_data):
                 self._teams[i + 1][data[j]] = ele_data.text.strip()
 
         return self._teams
@@ -95,12 +104,43 @@ class Standings:
 
     @staticmethod
     def get_soup(page: str, head=None) -> BeautifulSoup:
-        """Method to get the soup for a page"""
-        _req = requests.get(url=page, headers=head, timeout=10)
-        _soup = BeautifulSoup(_req.text, "html.parser")
+        """Method to get the soup for a page, raising HTTPError on an error page"""
+        _req = httpclient.get(page, headers=head)
+        _req.raise_for_status()
+        _soup = make_soup(_req.text, parsing.STANDINGS)
         return _soup
 
 
+def standings_table(head=None) -> str:
+    """Return the standings as a <pre> block, downloaded and parsed once for
+    everybody asking until the cache expires"""
+    return STANDINGS.get_or_load(
+        "clasi", lambda: get_standings_table(head), ttl=standings_ttl()
+    )
+
+
+def get_standings_table(head=None) -> str:
+    """Download the standings page once and render it"""
+    clasi = Standings(Standings.get_soup(Standings.get_search_url(), head))
+    return f"<pre>{clasi}</pre>"
+
+
+def standings_ttl(now: datetime = None) -> float:
+    """Seconds to keep the standings: a few minutes while there are matches and
+    until the next matchday starts the rest of the week"""
+    now = now or datetime.now()
+    if now.weekday() in cf.MATCHDAYS and now.hour >= cf.MATCH_HOUR:
+        return cf.STANDINGS_TTL["matchday"]
+
+    start = now.replace(hour=cf.MATCH_HOUR, minute=0, second=0, microsecond=0)
+    while start <= now or start.weekday() not in cf.MATCHDAYS:
+        start += timedelta(days=1)
+    return min(cf.STANDINGS_TTL["rest"], (start - now).total_seconds())
+
+
+STANDINGS = LRUCache(max_entries=1)  # Rendered standings
+
+
 @dataclass
 class Football:
     """Dataclass to manage all the football info"""
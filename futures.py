@@ -0,0 +1,14 @@
+"""Helpers for the futures of the background pools"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def log_error(what: str):
+    """Return a done callback of futures that logs their exception as 'what failed'"""
+
+    def callback(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("%s failed", what, exc_info=future.exception())
+
+    return callback
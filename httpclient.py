@@ -0,0 +1,94 @@
+"""Shared HTTP client for every web scrapping module"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config as cf
+from metrics import count, span
+
+RETRY_STATUS = (500, 502, 503, 504)  # A 429 is not retried, the caller backs off
+
+_session = requests.Session()
+# Retries are made by get(), so the wait between them does not hold a host slot
+_adapter = HTTPAdapter(
+    pool_connections=cf.HTTP["hosts"],
+    pool_maxsize=cf.HTTP["per_host"] + cf.HTTP["background_per_host"],
+    max_retries=0,
+)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+_limits = {}  # (host, background) -> semaphore of requests at the same time
+_background = contextvars.ContextVar("background", default=False)
+_lock = threading.Lock()
+_requests = 0  # Requests sent through the client
+
+
+def _limit(host: str, in_background: bool) -> threading.BoundedSemaphore:
+    """Return the semaphore for a host, a separate one for background requests"""
+    with _lock:
+        semaphore = _limits.get((host, in_background))
+        if semaphore is None:
+            size = cf.HTTP["background_per_host" if in_background else "per_host"]
+            semaphore = _limits[(host, in_background)] = threading.BoundedSemaphore(size)
+        return semaphore
+
+
+@contextmanager
+def background():
+    """Make the requests of the block background ones: they are never retried
+    and use their own slots of each host, never those of the user commands"""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def get(url: str, headers: dict = None, timeout: float = None) -> requests.Response:
+    """GET a page reusing the kept-alive connections of its host.
+
+    A 5xx or a failed connection is tried again up to cf.HTTP["retries"] times,
+    sleeping between tries without holding the slot of the host.
+    """
+    global _requests  # pylint: disable=global-statement
+    host = urlsplit(url).netloc
+    in_background = _background.get()
+    retries = 0 if in_background else cf.HTTP["retries"]
+    for attempt in range(retries + 1):
+        try:
+            with _limit(host, in_background), span("http_get", host=host):
+                response = _session.get(
+                    url, headers=headers, timeout=timeout or cf.HTTP["timeout"]
+                )
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            count("http_received_bytes", len(response.content), host=host)
+            with _lock:
+                _requests += 1
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+        time.sleep(cf.HTTP["backoff"] * 2**attempt)
+
+
+def stats() -> dict:
+    """Return the counters of the client: requests sent, connections opened
+    (each one a TCP+TLS handshake) and requests that reused a pooled one"""
+    pools = _adapter.poolmanager.pools
+    connections = 0
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            connections += pool.num_connections
+    return {
+        "requests": _requests,
+        "connections": connections,
+        "reused": max(_requests - connections, 0),
+    }
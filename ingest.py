@@ -0,0 +1,100 @@
+"""Queue between the webhook and the bot for the updates sent by Telegram"""
+import logging
+import queue
+import threading
+import time
+
+import telebot
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+QUEUED, DUPLICATE, FULL = "queued", "duplicate", "full"
+
+
+def _chat_of(update: telebot.types.Update):
+    """Return the chat id of an update, None if it has no chat"""
+    message = update.message or update.edited_message or update.channel_post
+    if message is None and update.callback_query is not None:
+        message = update.callback_query.message
+    return None if message is None else message.chat.id
+
+
+class UpdateQueue:
+    """Bounded queue of updates consumed by a pool of workers.
+
+    The updates of a chat always go to the same worker, so they are handled
+    in the order they came. An update_id already seen is dropped, and a full
+    queue refuses the update so that Telegram delivers it again later.
+    """
+
+    def __init__(self, process, max_size: int, workers: int, dedup: int):
+        self.process = process  # Called with a list of updates
+        self.workers = workers
+        self._queues = [queue.Queue(max(max_size // workers, 1)) for _ in range(workers)]
+        self._seen = LRUCache(dedup)  # update_id -> True of the last updates
+        self._lock = threading.Lock()
+        self._started = False
+        self.stats = {
+            "received": 0,
+            "duplicates": 0,
+            "refused": 0,  # Queue full, left for Telegram to send again
+            "processed": 0,
+            "failed": 0,
+            "max_depth": 0,
+            "wait": 0.0,  # Seconds the processed updates spent in the queue
+        }
+
+    def depth(self) -> int:
+        """Return the updates waiting in the queue"""
+        return sum(worker.qsize() for worker in self._queues)
+
+    def push(self, body: str) -> str:
+        """Queue the JSON of an update and return QUEUED, DUPLICATE or FULL.
+        Raise ValueError, KeyError, TypeError or AttributeError if it is not one."""
+        update = telebot.types.Update.de_json(body)
+        if not isinstance(update.update_id, int):
+            raise TypeError(f"update_id {update.update_id!r} is not an int")
+        self._start()
+        with self._lock:
+            self.stats["received"] += 1
+            if self._seen.get(update.update_id):
+                self.stats["duplicates"] += 1
+                return DUPLICATE
+            worker = self._queues[hash(_chat_of(update)) % self.workers]
+            try:
+                worker.put_nowait((time.monotonic(), update))
+            except queue.Full:
+                self.stats["refused"] += 1
+                return FULL
+            self._seen.put(update.update_id, True)
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.depth())
+        return QUEUED
+
+    def _start(self):
+        """Start the workers the first time"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for num, worker in enumerate(self._queues):
+            threading.Thread(
+                name=f"updates_{num}", target=self._consume, args=(worker,), daemon=True
+            ).start()
+
+    def _consume(self, worker: queue.Queue):
+        """Hand the updates of a queue to the bot"""
+        while True:
+            queued, update = worker.get()
+            waited = time.monotonic() - queued
+            try:
+                self.process([update])
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Update %s failed", update.update_id)
+                failed = True
+            else:
+                failed = False
+            with self._lock:
+                self.stats["failed" if failed else "processed"] += 1
+                self.stats["wait"] += waited
@@ -0,0 +1,527 @@
+"""Storage engine for the movie/serie lists"""
+import glob
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import config as cf
+from metrics import count
+from searchindex import SearchIndex
+
+LINE_PREFIX = re.compile(r"^\d+--- ?")  # 'NNN--- ' prefix of the old text files
+
+logger = logging.getLogger(__name__)
+
+_stores = {}  # One store per list file
+_stores_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ListMeta:
+    """Metadata of a list valid while the database file keeps the same stamp"""
+
+    count: int
+    snapshot: int  # mtime_ns of the text snapshot last written or imported, 0 if none
+    stamp: tuple
+
+
+class ListStore:
+    """List kept in SQLite where the position is the logical order of the rows.
+
+    Positions are never written to disk, so editing or deleting an item only
+    touches its own row and the following items get their new number for free.
+
+    The database runs in WAL mode: every write is one append to the journal
+    ('-wal' file) and SQLite replays it if the dyno dies before it is merged.
+    Every cf.COMPACT_EVERY writes the journal is merged into the database and
+    the old text file is rewritten as a snapshot by atomic rename.
+    """
+
+    def __init__(self, path: str, export: str = None):
+        self.path = path
+        self.export = export  # Text file kept as a snapshot of the list
+        self.name = os.path.basename(export or path)  # Label of its metrics
+        self._local = threading.local()
+        self._meta = None
+        self._index = None
+        self._writes = 0  # Writes since the last compaction
+        self._lock = RWLock()
+        self._queue = []  # Operations waiting for the next write transaction
+        self._queue_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL)"
+            )
+            # The count is kept by triggers, so it is right even after manual edits
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                "count INTEGER NOT NULL, snapshot INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(meta)")]
+            if "snapshot" not in columns:  # Database made before it was recorded
+                conn.execute(
+                    "ALTER TABLE meta ADD COLUMN snapshot INTEGER NOT NULL DEFAULT 0"
+                )
+            # Triggers of older databases also kept the last id, that nobody read
+            conn.execute("DROP TRIGGER IF EXISTS items_insert")
+            conn.execute("DROP TRIGGER IF EXISTS items_delete")
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS items_count_insert AFTER INSERT ON items "
+                "BEGIN UPDATE meta SET count = count + 1; END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS items_count_delete AFTER DELETE ON items "
+                "BEGIN UPDATE meta SET count = count - 1; END"
+            )
+            if conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0] == 0:
+                conn.execute("INSERT INTO meta (count) SELECT COUNT(*) FROM items")
+        self._checkpoint()  # Merge what was left in the journal by a crash
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            # In WAL mode a commit only needs to reach the journal, not to be synced
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _checkpoint(self):
+        """Merge the journal into the database and empty it"""
+        self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _id_at(self, conn, pos: int) -> int:
+        """Return the row id of the item in the position 'pos' (starting at 1)"""
+        if pos < 1:  # SQLite reads a negative OFFSET as 0
+            raise IndexError(f"position {pos} out of range")
+        row = conn.execute(
+            "SELECT id FROM items ORDER BY id LIMIT 1 OFFSET ?", (pos - 1,)
+        ).fetchone()
+        if row is None:
+            raise IndexError(f"position {pos} out of range")
+        return row[0]
+
+    def _stamp(self) -> tuple:
+        """Return the modification time and size of the database and its journal"""
+        stamp = ()
+        for path in (self.path, f"{self.path}-wal"):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stamp += (stat.st_mtime_ns, stat.st_size)
+        return stamp
+
+    def _load_meta(self) -> ListMeta:
+        """Read the metadata row and remember it with the current stamp"""
+        stamp = self._stamp()
+        count, snapshot = (
+            self._connection().execute("SELECT count, snapshot FROM meta").fetchone()
+        )
+        self._meta = ListMeta(count, snapshot, stamp)
+        return self._meta
+
+    def meta(self) -> ListMeta:
+        """Return the metadata, reading it again only if the file has changed"""
+        meta = self._meta
+        if meta is None or meta.stamp != self._stamp():
+            meta = self._load_meta()
+        return meta
+
+    def count(self) -> int:
+        """Return the number of items"""
+        with self._lock.read():
+            return self.meta().count
+
+    def _io(self, direction: str, titles):
+        """Count the bytes of the titles read or written"""
+        count(
+            f"list_{direction}_bytes",
+            sum(len(title.encode()) for title in titles),
+            file=self.name,
+        )
+
+    def titles(self) -> list:
+        """Return every title ordered by position"""
+        with self._lock.read():
+            rows = self._connection().execute("SELECT title FROM items ORDER BY id")
+            titles = [row[0] for row in rows]
+        self._io("read", titles)
+        return titles
+
+    def tail(self, num: int) -> list:
+        """Return the last 'num' items as (position, title)"""
+        with self._lock.read():
+            total = self.meta().count
+            rows = self._connection().execute(
+                "SELECT title FROM items ORDER BY id DESC LIMIT ?", (num,)
+            ).fetchall()
+        self._io("read", (row[0] for row in rows))
+        return [(total - i, row[0]) for i, row in reversed(list(enumerate(rows)))]
+
+    def page(self, start: int, num: int) -> list:
+        """Return up to 'num' items from the position 'start' as (position, title)"""
+        with self._lock.read():
+            rows = self._connection().execute(
+                "SELECT title FROM items ORDER BY id LIMIT ? OFFSET ?", (num, start - 1)
+            ).fetchall()
+        self._io("read", (row[0] for row in rows))
+        return [(start + i, row[0]) for i, row in enumerate(rows)]
+
+    def get(self, pos: int) -> str:
+        """Return the title in the position 'pos'"""
+        with self._lock.read():
+            row = self._connection().execute(
+                "SELECT title FROM items ORDER BY id LIMIT 1 OFFSET ?", (pos - 1,)
+            ).fetchone()
+        if row is None:
+            raise IndexError(f"position {pos} out of range")
+        self._io("read", row)
+        return row[0]
+
+    def _read_index(self) -> SearchIndex:
+        """Return the search index, reading every title again if the file has changed"""
+        stamp = self._stamp()
+        index = self._index
+        if index is None or index.stamp != stamp:
+            index = SearchIndex(stamp)
+            rows = self._connection().execute("SELECT id, title FROM items ORDER BY id")
+            read = 0
+            for id_, title in rows:
+                index.add(id_, title)
+                read += len(title.encode())
+            count("list_read_bytes", read, file=self.name)
+            self._index = index
+        return index
+
+    def search(self, query: str) -> list:
+        """Return the (position, title) of the items matching the query"""
+        with self._lock.read():
+            return self._read_index().search(query)
+
+    def fuzzy_search(self, query: str, limit: int) -> list:
+        """Return the best (score, position, title) for a query with typos"""
+        with self._lock.read():
+            return self._read_index().fuzzy_search(query, limit)
+
+    def _fresh_index(self):
+        """Return the index if it is up to date with the file, None otherwise"""
+        index = self._index
+        if index is not None and index.stamp == self._stamp():
+            return index
+        return None
+
+    def _id_for(self, conn, index, pos: int) -> int:
+        """Return the row id of a position using the index when there is one"""
+        if index is not None:
+            return index.id_at(pos)
+        return self._id_at(conn, pos)
+
+    def _write(self, operation):
+        """Run 'operation(conn, index)' as part of the next write transaction.
+
+        Writers queue their operation and whoever gets the write lock commits
+        every queued operation in one transaction, so a burst of /add costs a
+        single commit. When the lock is ours our operation is already done.
+        """
+        job = {"operation": operation}
+        with self._queue_lock:
+            self._queue.append(job)
+        with self._lock.write():
+            with self._queue_lock:
+                batch, self._queue = self._queue, []
+            if batch:
+                self._commit(batch)
+        if "error" in job:
+            raise job["error"]
+        return job["result"]
+
+    def _commit(self, batch: list):
+        """Apply a batch of operations in one transaction"""
+        index = self._fresh_index()
+        try:
+            with self._connection() as conn:
+                for job in batch:
+                    try:
+                        job["result"] = job["operation"](conn, index)
+                    except IndexError as error:  # Raised before touching anything
+                        job["error"] = error
+        except Exception as error:  # pylint: disable=broad-except
+            # The whole transaction was rolled back, so every job failed
+            self._index = None  # It has changes that were rolled back
+            for job in batch:
+                job.pop("result", None)
+                job.setdefault("error", error)
+            return
+        self._committed(index, len(batch))
+
+    def _committed(self, index, writes: int = 1) -> ListMeta:
+        """Read the metadata after a write and keep the updated index valid"""
+        meta = self._load_meta()
+        if index is not None:
+            index.stamp = meta.stamp
+        self._writes += writes
+        if self._writes >= cf.COMPACT_EVERY:
+            self._compact()
+        return meta
+
+    def compact(self):
+        """Merge the journal into the database and rewrite the text snapshot"""
+        with self._lock.write():
+            self._compact()
+
+    def _compact(self):
+        """Compaction for callers already holding the write lock"""
+        index = self._fresh_index()
+        if self.export is not None:
+            tmp = f"{self.export}.tmp"
+            rows = self._connection().execute("SELECT title FROM items ORDER BY id")
+            lines = [f"{pos:03d}--- {row[0]}\n" for pos, row in enumerate(rows, 1)]
+            with open(tmp, "w", encoding="utf8") as txt:
+                txt.writelines(lines)
+                txt.flush()
+                os.fsync(txt.fileno())
+            os.replace(tmp, self.export)
+            self._io("written", lines)
+            with self._connection() as conn:
+                conn.execute(
+                    "UPDATE meta SET snapshot = ?", (os.stat(self.export).st_mtime_ns,)
+                )
+        self._checkpoint()
+        self._writes = 0
+        meta = self._load_meta()
+        if index is not None:
+            index.stamp = meta.stamp
+
+    @staticmethod
+    def _count(conn) -> int:
+        """Return the count inside the current transaction"""
+        return conn.execute("SELECT count FROM meta").fetchone()[0]
+
+    def append(self, title: str) -> int:
+        """Append a title and return its position"""
+
+        def operation(conn, index):
+            id_ = conn.execute("INSERT INTO items (title) VALUES (?)", (title,)).lastrowid
+            if index is not None:
+                index.add(id_, title)
+            return self._count(conn)
+
+        pos = self._write(operation)
+        self._io("written", (title,))
+        return pos
+
+    def append_many(self, titles: list) -> int:
+        """Append several titles in one transaction and return the first position"""
+
+        def operation(conn, index):
+            first = self._count(conn) + 1
+            for title in titles:
+                id_ = conn.execute(
+                    "INSERT INTO items (title) VALUES (?)", (title,)
+                ).lastrowid
+                if index is not None:
+                    index.add(id_, title)
+            return first
+
+        first = self._write(operation)
+        self._io("written", titles)
+        return first
+
+    def update(self, pos: int, title: str):
+        """Replace the title in the position 'pos'"""
+
+        def operation(conn, index):
+            id_ = self._id_for(conn, index, pos)
+            conn.execute("UPDATE items SET title = ? WHERE id = ?", (title, id_))
+            if index is not None:
+                index.update(id_, title)
+
+        self._write(operation)
+        self._io("written", (title,))
+
+    def delete(self, pos: int) -> str:
+        """Delete the item in the position 'pos' and return its title"""
+
+        def operation(conn, index):
+            id_ = self._id_for(conn, index, pos)
+            title = conn.execute(
+                "SELECT title FROM items WHERE id = ?", (id_,)
+            ).fetchone()[0]
+            conn.execute("DELETE FROM items WHERE id = ?", (id_,))
+            if index is not None:
+                index.remove(id_)
+            return title
+
+        return self._write(operation)
+
+    def delete_many(self, positions: list) -> list:
+        """Delete several positions in one transaction and return their titles"""
+
+        def operation(conn, index):
+            if index is not None:
+                ids = [index.id_at(pos) for pos in positions]
+                titles = [index.title(id_) for id_ in ids]
+            else:
+                rows = conn.execute("SELECT id, title FROM items ORDER BY id").fetchall()
+                if positions and (min(positions) < 1 or max(positions) > len(rows)):
+                    raise IndexError("position out of range")
+                ids = [rows[pos - 1][0] for pos in positions]
+                titles = [rows[pos - 1][1] for pos in positions]
+            conn.executemany("DELETE FROM items WHERE id = ?", ((id_,) for id_ in ids))
+            if index is not None:
+                for id_ in ids:
+                    index.remove(id_)
+            return list(titles)
+
+        return self._write(operation)
+
+    def delete_last(self) -> tuple:
+        """Delete the last item and return its (position, title)"""
+
+        def operation(conn, index):
+            row = conn.execute(
+                "SELECT id, title FROM items ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                raise IndexError("empty list")
+            pos = self._count(conn)
+            conn.execute("DELETE FROM items WHERE id = ?", (row[0],))
+            if index is not None:
+                index.remove(row[0])
+            return (pos, row[1])
+
+        return self._write(operation)
+
+    def import_lines(self, lines, snapshot: int = 0):
+        """Replace the content of the store with the lines of an old text file,
+        'snapshot' being the mtime_ns of that file"""
+        titles = [
+            (LINE_PREFIX.sub("", line.rstrip("\n")),) for line in lines if line.strip()
+        ]
+
+        def operation(conn, _):
+            conn.execute("DELETE FROM items")
+            conn.executemany("INSERT INTO items (title) VALUES (?)", titles)
+            conn.execute("UPDATE meta SET snapshot = ?", (snapshot,))
+
+        self._write(operation)
+        self._io("written", (title for title, in titles))
+        self._index = None
+
+
+class RWLock:
+    """Lock for many readers or one writer, writers go first when waiting"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """Hold the lock for reading"""
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        """Hold the lock for writing"""
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def store_path(file: str) -> str:
+    """Return the path of the database for a list file"""
+    return os.path.splitext(file)[0] + ".db"
+
+
+def import_txt(file: str, force: bool = False) -> ListStore:
+    """Import an old 'NNN--- title' text file into its store.
+
+    Raise ValueError if the file is older than the last snapshot written by
+    the store, as importing it would undo the changes made since then.
+    """
+    store = open_store(file, auto_import=False)
+    snapshot = os.stat(file).st_mtime_ns
+    if not force and snapshot < store.meta().snapshot:
+        raise ValueError(f"{file} is older than the last compaction of {store.path}")
+    with open(file, "r", encoding="utf8") as txt:
+        store.import_lines(txt, snapshot)
+    return store
+
+
+def import_all(directory: str = "./files/", force: bool = False) -> list:
+    """One-shot import of every text list found in 'directory'"""
+    return [
+        import_txt(file, force) for file in sorted(glob.glob(f"{directory}*.txt"))
+    ]
+
+
+def _check_snapshot(store: ListStore, file: str, new: bool):
+    """Import the text file into a new store, and warn when the text file of an
+    existing store is not the snapshot it wrote last"""
+    snapshot = os.stat(file).st_mtime_ns
+    if new:
+        # Changes made after its last compaction were only in the lost database
+        logger.warning("No database for %s, importing its text snapshot", file)
+        with open(file, "r", encoding="utf8") as txt:
+            store.import_lines(txt, snapshot)
+        return
+    last = store.meta().snapshot
+    if snapshot < last:
+        logger.warning(
+            "%s is older than the last compaction, ignored until the next one", file
+        )
+    elif snapshot > last and last:
+        logger.warning(
+            "%s changed after the last compaction, ignored; import it with import_txt",
+            file,
+        )
+
+
+def open_store(file: str, auto_import: bool = True) -> ListStore:
+    """Return the store of a list file, importing the text file the first time"""
+    key = os.path.abspath(file)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            path = store_path(file)
+            new = not os.path.exists(path)
+            store = ListStore(path, export=file)
+            if auto_import and os.path.exists(file):
+                _check_snapshot(store, file, new)
+            _stores[key] = store
+    return store
+
+
+if __name__ == "__main__":
+    for imported in import_all():
+        print(f"{imported.path}: {imported.count()} items")
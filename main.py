@@ -1,6 +1,7 @@
 """Bot main application"""
+import hmac
 import os
-import pickle
+import re
 import threading
 import time
 from dataclasses import dataclass
@@ -8,7 +9,6 @@ from dataclasses import dataclass
 import pyjokes
 import requests
 import telebot
-from bs4 import BeautifulSoup
 from flask import Flask, request
 from telebot.types import (
     ForceReply,
@@ -21,12 +21,25 @@ from waitress import serve
 
 import config as cf
 import filetreatment as ft
-from filmaffinity import GENRES, FilmAffinity
-from futbol import Standings
+import httpclient
+from cache import LRUCache
+from filmaffinity import FilmAffinity
+from futbol import standings_table
+from ingest import FULL, UpdateQueue
+from metrics import collect, render, timed
+from outbox import Outbox
+from pipeline import dispatch
+from prefetch import PREFETCHER, prefetch
+from sessions import SESSIONS, start_janitor
+from state import ChatState
+
+POSITIONS = re.compile(r"\d+(-\d+)?(,\d+(-\d+)?)*")  # Argument like '3-7,12'
 
 bot = telebot.TeleBot(cf.API_KEY)  # Instance of bot
+OUTBOX = Outbox(bot, **cf.OUTBOX)  # Messages sent to the chats
 web_server = Flask(__name__)  # Instance of web server
-data = {}  # Dictionary to save the state of the     bot
+UPDATES = UpdateQueue(bot.process_new_updates, **cf.WEBHOOK)  # Updates of the webhook
+STATE = ChatState(**cf.STATE)  # State of the conversation of every chat
 for key in cf.DIR:  # Create directory
     try:
         os.mkdir(key)
@@ -36,12 +49,38 @@ for key in cf.DIR:  # Create directory
 
 @web_server.route("/", methods=["POST"])
 def webhook():
-    """Function for using webhook"""
-    # If POST is a JSON
-    if request.headers.get("content-type") == "application/json":
-        update = telebot.types.Update.de_json(request.stream.read().decode("utf-8"))
-        bot.process_new_updates([update])
-        return "OK", 200
+    """Function for using webhook: queue the update and answer Telegram at once"""
+    if not request.is_json:
+        return "Unsupported Media Type", 415
+    try:
+        status = UPDATES.push(request.get_data(as_text=True))
+    except (ValueError, KeyError, TypeError, AttributeError):  # Not an update
+        return "Bad Request", 400
+    if status == FULL:  # Telegram will send it again later
+        return "Service Unavailable", 503
+    return "OK", 200
+
+
+@web_server.route("/metrics", methods=["GET"])
+def metrics_page():
+    """Metrics of the bot in the Prometheus text format, only with the token"""
+    token = cf.METRICS["token"]
+    if token is None:
+        return "Not Found", 404
+    if not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()
+    ):
+        return "Unauthorized", 401
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+collect(
+    "updates",
+    lambda: {**UPDATES.stats, "depth": UPDATES.depth()},
+    counters=("received", "duplicates", "refused", "processed", "failed", "wait"),
+)
+collect("outbox", lambda: OUTBOX.stats, counters=("sent", "coalesced", "limited"))
+collect("http", httpclient.stats, counters=("requests", "connections", "reused"))
 
 
 # """ <b>
@@ -58,12 +97,18 @@ class AreNenes(telebot.SimpleCustomFilter):
     @staticmethod
     def check(message: telebot.types.Message) -> bool:  # pylint: disable=W0221
         """Check whether nenes are using the handler"""
-        return bot.get_chat(message.chat.id).id in [
-            cf.NENE_ID,
-            cf.NENA_ID,
-            cf.PRUEBA_GROUP_ID,
-            cf.PETENOS_GROUP_ID,
-        ]
+        chatid = message.chat.id
+        if chatid not in NENES:
+            return False
+        if cf.VERIFY_CHATS_TTL is None:  # No need to ask Telegram
+            return True
+        return VERIFIED_CHATS.get_or_load(
+            chatid, lambda: bot.get_chat(chatid).id == chatid, ttl=cf.VERIFY_CHATS_TTL
+        )
+
+
+NENES = frozenset((cf.NENE_ID, cf.NENA_ID, cf.PRUEBA_GROUP_ID, cf.PETENOS_GROUP_ID))
+VERIFIED_CHATS = LRUCache(max_entries=len(NENES))  # Chats checked with get_chat
 
 
 # """ *****************************************************
@@ -89,10 +134,12 @@ def helpnenes(commands) -> str:
     """Method when command called is /help nenes"""
     response = (
         f"<code><b>{commands[1]}</b></code> | Muestra la lista de películas o series.\n"
-        f'<code><b>{commands[3]}</b></code> | Añade "nombre" en películas o series.\n'
+        f'<code><b>{commands[3]}</b></code> | Añade "nombre" en películas o series (uno por línea).\n'
         f'<code><b>{commands[4]}</b></code> | Edita "nombre" en película o serie.\n'
-        f'<code><b>{commands[5]}</b></code> | Borra "nombre" en película o serie.\n'
+        f'<code><b>{commands[5]}</b></code> | Borra "número" en película o serie (-last, 3-7,12).\n'
         f'<code><b>{commands[2]}</b></code> | Busca "nombre" en películas o series.\n'
+        f'<code><b>{commands[2]}</b> -m -fuzzy nombre</code> | Busca "nombre" aunque esté mal escrito (-fuzzy va justo antes del nombre).\n'
+        f'<code><b>{commands[2]}</b> -all</code> | Busca "nombre" en todas las listas.\n'
         f"<code><b>{commands[8]}</b></code> | Lista los 10 últimos en películas o series.\n"
         f"\nArgumentos:   <b><code>-m   -mt   -s   -st</code></b>\n"
     )
@@ -130,6 +177,7 @@ def helpfutbol() -> str:
 
 
 @bot.message_handler(are_nenes=True, commands=["start", "help"])
+@timed("handler")
 def help_(message):
     """To show help"""
     commands = (
@@ -159,7 +207,7 @@ def help_(message):
             response = helpfutbol()
         else:  # En caso de argumento incorrecto
             response = "Argumento incorrecto"
-    bot.send_message(
+    OUTBOX.send_message(
         message.chat.id,
         response,
         parse_mode="html",
@@ -168,10 +216,11 @@ def help_(message):
 
 
 @bot.message_handler(are_nenes=True, commands=["chiste"])
+@timed("handler")
 def chiste(message):
     """Manda una chiste"""
     joke = pyjokes.get_joke(language="es", category="all")
-    bot.send_message(message.chat.id, joke)
+    OUTBOX.send_message(message.chat.id, joke)
 
 
 # """ Methods to obtain the correct file to work with """
@@ -209,11 +258,7 @@ def get_file(message) -> str:
             if len(arg) < 3:
                 res = None
         case "/del":
-            if len(arg) < 3:
-                res = None
-            if arg[2] == "-last":
-                res = file
-            if not arg[2].isdigit():
+            if len(arg) < 3 or (arg[2] != "-last" and not POSITIONS.fullmatch(arg[2])):
                 res = None
         case "/edit":
             if len(arg) < 4 or not arg[2].isdigit():
@@ -229,7 +274,7 @@ def get_file(message) -> str:
 # """HANDLE FILE BUTTON (FOR EVERYONE)"""
 
 
-def buttons_ask_file(message) -> str:
+def buttons_ask_file(message):
     """Function to handle the file button that is the same for every command"""
     file_button = ReplyKeyboardMarkup(
         one_time_keyboard=True,
@@ -238,177 +283,273 @@ def buttons_ask_file(message) -> str:
     )
     file_button.add("Movies", "Movies to see", "Series", "Series to see", row_width=2)
 
-    msg = bot.send_message(
-        message.chat.id, "Elige el fichero:", reply_markup=file_button
+    OUTBOX.send_message(message.chat.id, "Elige el fichero:", reply_markup=file_button)
+
+
+def expired(message) -> bool:
+    """Tell the user to start again if the conversation of the chat has expired"""
+    if STATE.get(message.chat.id, "command") is not None:
+        return False
+    OUTBOX.send_message(
+        message.chat.id,
+        "Se te ha pasado el arroz, vuelve a empezar el comando.",
+        reply_markup=ReplyKeyboardRemove(),
     )
-    return msg
+    return True
 
 
 # """COMMAND: LIST / LAST"""
 
 
 @bot.message_handler(are_nenes=True, commands=["list"])
+@timed("handler")
 def list_command(message):
     """Command list for any movie/serie"""
     file = get_file(message)
-    data[message.chat.id] = {}  # Dict of dicts of ID. Every person in different dict
-    data[message.chat.id]["command"] = "list"
+    STATE.start(message.chat.id, "list")
 
     if file is None:  # Controlling commands with buttons
-        response = buttons_ask_file(message)
-        bot.register_next_step_handler(response, handler_list_last)
+        buttons_ask_file(message)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, handler_list_last)
     else:  # Or only with the full text command
-        lst = ft.list_(file)
-        bot.send_message(message.chat.id, "".join(str(i) for i in lst))
+        show_list_page(message.chat.id, file)
 
 
 @bot.message_handler(are_nenes=True, commands=["last"])
+@timed("handler")
 def last_command(message):
     """Command last for last 10 movies/series"""
     file = get_file(message)
-    data[message.chat.id] = {}  # Dictionary of dictionary of ID.
-    data[message.chat.id]["command"] = "last"
+    STATE.start(message.chat.id, "last")
     if file is None:  # Controlling commands with buttons
-        response = buttons_ask_file(message)
-        bot.register_next_step_handler(response, handler_list_last)
+        buttons_ask_file(message)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, handler_list_last)
     else:
         lst = ft.find_last(file)
-        bot.send_message(message.chat.id, "".join(str(i) for i in lst))
+        OUTBOX.send_message(message.chat.id, "".join(str(i) for i in lst))
 
 
+@timed("handler")
 def handler_list_last(message):
     """Last step for control list with buttons"""
+    if expired(message):
+        return
     file = []
     file.append(message.text.lower())
     file = check_file(file)
     if file is None:
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             "Ese fichero no existe, pecador de la pradera!!",
             reply_markup=ReplyKeyboardRemove,
         )
-    else:
-        lst = ft.list_(file)
-        if data[message.chat.id]["command"] == "last":
-            lst = ft.find_last(file)
-        bot.send_message(
+    elif STATE.get(message.chat.id, "command") == "last":
+        lst = ft.find_last(file)
+        OUTBOX.send_message(
             message.chat.id,
             "".join(str(i) for i in lst),
             reply_markup=ReplyKeyboardRemove(),
         )
-    data.clear()
+    else:
+        show_list_page(message.chat.id, file)
+    STATE.finish(message.chat.id)
+
+
+def show_list_page(chatid, file, pag=0, messageid=None):
+    """Create or edit the message with a page of a list"""
+    lst, length = ft.list_page(file, pag, cf.N_LIST_PAG)
+    if not lst:
+        OUTBOX.send_message(
+            chatid, "La lista está vacía.", reply_markup=ReplyKeyboardRemove()
+        )
+        return
+
+    # The buttons carry the list and the page they go to, so no state is kept
+    list_id = cf.LISTS.index(file)
+    last_pag = (length - 1) // cf.N_LIST_PAG
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("⬅️", callback_data=f"list:{list_id}:{pag - 1}"),
+        InlineKeyboardButton("❌", callback_data="list:close"),
+        InlineKeyboardButton("➡️", callback_data=f"list:{list_id}:{pag + 1}"),
+    )
+    start_ = pag * cf.N_LIST_PAG
+    text_ = (
+        f"Página {pag + 1}/{last_pag + 1} "
+        f"({start_ + 1}-{start_ + len(lst)} de {length})\n\n"
+    )
+    text_ += "".join(lst)
+
+    if messageid:
+        OUTBOX.edit_message_text(text_, chatid, messageid, reply_markup=markup)
+    else:
+        OUTBOX.send_message(chatid, text_, reply_markup=markup)
+
+
+@bot.callback_query_handler(func=lambda x: x.data.startswith("list:"))
+@timed("handler")
+def list_buttons(call):
+    """Manage the behaviour of the buttons of /list"""
+    chatid = call.message.chat.id
+    messageid = call.message.id
+
+    if call.data == "list:close":
+        OUTBOX.delete_message(chatid, messageid)
+        return
+
+    list_id, pag = (int(i) for i in call.data.split(":")[1:])
+    file = cf.LISTS[list_id]
+    if pag < 0:
+        bot.answer_callback_query(call.id, "Ya estás en la primera página")
+    elif pag * cf.N_LIST_PAG >= ft.len_(file):
+        bot.answer_callback_query(call.id, "Ya estás en la última página")
+    else:
+        show_list_page(chatid, file, pag, messageid)
 
 
 # """COMMAND: FIND / ADD"""
 
 
 @bot.message_handler(are_nenes=True, commands=["find"])
+@timed("handler")
 def find_command(message):
     """Command list for any movie/serie"""
+    req = message.text.split()
+    if req[1:2] == ["-all"] and req[2:]:  # Search in every list
+        OUTBOX.send_message(message.chat.id, find_response(None, req[2:]))
+        return
+
     file = get_file(message)
-    data[message.chat.id] = {}  # Dictionary of dictionary of ID.
-    data[message.chat.id]["command"] = "find"
+    STATE.start(message.chat.id, "find")
     if file is None:  # Controlling commands with buttons
-        response = buttons_ask_file(message)
-        bot.register_next_step_handler(response, find_add_ask_name)
+        buttons_ask_file(message)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, find_add_ask_name)
     else:
-        error = "No se ha encontrado."
-        lst = ft.find_(file, message.text.split()[2:])
-        bot.send_message(
-            message.chat.id, [error if not lst else "".join(str(i) for i in lst)]
-        )
+        response = find_response(file, message.text.split()[2:])
+        OUTBOX.send_message(message.chat.id, response)
+
+
+def find_response(file, req) -> str:
+    """Search in the file (every list if None), ranking by similarity if asked
+    or if nothing is found"""
+    fuzzy = req[:1] == ["-fuzzy"]
+    if fuzzy:
+        req = req[1:]
+    if file is None:
+        lst = [] if fuzzy else ft.find_all(cf.LISTS, req)
+        if not lst:
+            lst = ft.find_fuzzy_all(cf.LISTS, req, cf.N_RES_FIND)
+    else:
+        lst = [] if fuzzy else ft.find_(file, req)
+        if not lst:
+            lst = ft.find_fuzzy(file, req, cf.N_RES_FIND)
+    if not lst:
+        return "No se ha encontrado."
+
+    # Telegram refuses messages over 4096 characters
+    response, shown = "", 0
+    for item in lst[: cf.MAX_RES_FIND]:
+        if len(response) + len(item) > 3900:
+            break
+        response += item
+        shown += 1
+    if shown < len(lst):
+        response += f"\n... y {len(lst) - shown} más. Afina la búsqueda."
+    return response
 
 
 @bot.message_handler(are_nenes=True, commands=["add"])
+@timed("handler")
 def add_command(message):
     """Command add for any movie/serie"""
     file = get_file(message)
-    data[message.chat.id] = {}  # Dictionary of dictionary of ID.
-    data[message.chat.id]["command"] = "add"
+    STATE.start(message.chat.id, "add")
 
     if file is None:  # Controlling commands with buttons
-        response = buttons_ask_file(message)
-        bot.register_next_step_handler(response, find_add_ask_name)
+        buttons_ask_file(message)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, find_add_ask_name)
     else:
-        file_name = ft.which_file(file)
-        req = message.text.split()  # Get the movie to add
-        data[message.chat.id]["movie"] = " ".join(list(req[2:]))
-        movie = data[message.chat.id]["movie"]
-        pos = ft.len_(file)
+        lines = message.text.split("\n")  # One movie per line
+        movies = [" ".join(lines[0].split()[2:])] + lines[1:]
+        added_message(message.chat.id, file, movies)
 
-        ft.add(file, movie, pos + 1)
-        bot.send_message(
-            message.chat.id,
-            f'{file_name.capitalize().replace("_", " ")} #{pos+1} añadida:   {movie}',
-        )
 
+def added_message(chatid, file, movies):
+    """Add every movie in one go and send one confirmation"""
+    file_name = ft.which_file(file).capitalize().replace("_", " ")
+    movies = [movie.strip() for movie in movies if movie.strip()]
+    if not movies:
+        OUTBOX.send_message(chatid, "Error: no me has puesto qué añadir, perraca!")
+        return
 
+    added = ft.add_many(file, movies)
+    OUTBOX.send_message(
+        chatid,
+        "\n".join(f"{file_name} #{pos} añadida:   {movie}" for pos, movie in added),
+    )
+
+
+@timed("handler")
 def find_add_ask_name(message):
     """Next-step for asking name argument in find with buttons"""
+    if expired(message):
+        return
     file = []
     file.append(message.text.lower())
     file = check_file(file)
-    data[message.chat.id]["file"] = file
+    STATE.set(message.chat.id, "file", file)
 
     if file is None:
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             "Ese fichero no existe, pecador de la pradera!!",
             reply_markup=ReplyKeyboardRemove(),
         )
     else:
-        if data[message.chat.id]["command"] == "find":
-            msg = bot.send_message(
+        if STATE.get(message.chat.id, "command") == "find":
+            OUTBOX.send_message(
                 message.chat.id,
                 "Escribe la peli/serie a buscar:",
                 reply_markup=ForceReply(),
             )
-        if data[message.chat.id]["command"] == "add":
-            msg = bot.send_message(
+        if STATE.get(message.chat.id, "command") == "add":
+            OUTBOX.send_message(
                 message.chat.id,
                 "Escribe la peli/serie a añadir: ",
                 reply_markup=ForceReply(),
             )
-        bot.register_next_step_handler(msg, handler_find_add)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, handler_find_add)
 
 
+@timed("handler")
 def handler_find_add(message):
     """Last step for control find with buttons"""
-    error = "No se ha encontrado."
-    file = data[message.chat.id]["file"]
+    if expired(message):
+        return
+    file = STATE.get(message.chat.id, "file")
 
-    if data[message.chat.id]["command"] == "add":
-        file_name = ft.which_file(file)
-        movie = message.text
-        pos = ft.len_(file)
+    if STATE.get(message.chat.id, "command") == "add":
+        added_message(message.chat.id, file, message.text.split("\n"))
 
-        ft.add(file, movie, pos + 1)
-        bot.send_message(
-            message.chat.id,
-            f'{file_name.capitalize().replace("_", " ")} #{pos+1} añadida:   {movie}',
-        )
-
-    if data[message.chat.id]["command"] == "find":
-        lst = ft.find_(data[message.chat.id]["file"], message.text.split())
-        bot.send_message(
-            message.chat.id, [error if not lst else "".join(str(i) for i in lst)]
-        )
-    data.clear()
+    if STATE.get(message.chat.id, "command") == "find":
+        response = find_response(file, message.text.split())
+        OUTBOX.send_message(message.chat.id, response)
+    STATE.finish(message.chat.id)
 
 
 # """COMMAND: EDIT"""
 
 
 @bot.message_handler(are_nenes=True, commands=["edit"])
+@timed("handler")
 def edit_command(message):
     """Command edit for any movie/serie"""
     file = get_file(message)
-    data[message.chat.id] = {}  # Dictionary of dictionary of ID.
-    data[message.chat.id]["command"] = "add"
+    STATE.start(message.chat.id, "add")
 
     if file is None:  # Controlling commands with buttons
-        response = buttons_ask_file(message)
-        bot.register_next_step_handler(response, edit_ask_name)
+        buttons_ask_file(message)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, edit_ask_name)
     else:
         file_name = ft.which_file(file)
 
@@ -416,128 +557,157 @@ def edit_command(message):
         movie = " ".join(list(req[3:]))
         pos = int(req[2])
 
-        length = ft.len_(file)
-        if pos < 1 or pos > length:
-            bot.send_message(message.chat.id, f"Error: la película {pos} no existe.")
+        try:
+            ft.edit(file, movie, pos)
+        except IndexError:  # Checked in the write batch, so nothing was edited
+            OUTBOX.send_message(message.chat.id, f"Error: la película {pos} no existe.")
             return 1
-
-        ft.edit(file, movie, pos)
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             f'{file_name.capitalize().replace("_", " ")} #{pos} editada:   {movie}',
         )
 
 
+@timed("handler")
 def edit_ask_name(message):
     """Next-step for asking name argument in find with buttons"""
+    if expired(message):
+        return
     file = []
     file.append(message.text.lower())
     file = check_file(file)
-    data[message.chat.id]["file"] = file
+    STATE.set(message.chat.id, "file", file)
 
     if file is None:
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             "Ese fichero no existe, pecador de la pradera!!",
             reply_markup=ReplyKeyboardRemove(),
         )
     else:
-        msg = bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             "Escribe el número de peli/serie a editar:",
             reply_markup=ForceReply(),
         )
-        bot.register_next_step_handler(msg, edit_ask_num)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, edit_ask_num)
 
 
+@timed("handler")
 def edit_ask_num(message):
     """Step to control the number of movie to edit"""
-    file = data[message.chat.id]["file"]
+    if expired(message):
+        return
+    file = STATE.get(message.chat.id, "file")
     if not message.text.isdigit():
-        bot.send_message(message.chat.id, "Error: no me has puesto un número, perraca!")
+        OUTBOX.send_message(message.chat.id, "Error: no me has puesto un número, perraca!")
         return
 
     num_movie = int(message.text)
     length = ft.len_(file)
     if num_movie < 1 or num_movie > length:
-        bot.send_message(message.chat.id, f"Error: la película {num_movie} no existe.")
+        OUTBOX.send_message(message.chat.id, f"Error: la película {num_movie} no existe.")
         return 1
 
-    data[message.chat.id]["num_movie"] = num_movie
+    STATE.set(message.chat.id, "num_movie", num_movie)
 
-    msg = bot.send_message(
+    OUTBOX.send_message(
         message.chat.id, "Escribe el nuevo nombre:", reply_markup=ForceReply()
     )
-    bot.register_next_step_handler(msg, handler_edit)
+    bot.register_next_step_handler_by_chat_id(message.chat.id, handler_edit)
 
 
+@timed("handler")
 def handler_edit(message):
     """Last step for control edit with buttons"""
+    if expired(message):
+        return
     new_name_movie = message.text
-    file = data[message.chat.id]["file"]
-    pos = data[message.chat.id]["num_movie"]
+    file = STATE.get(message.chat.id, "file")
+    pos = STATE.get(message.chat.id, "num_movie")
 
     file_name = ft.which_file(file)
 
-    ft.edit(file, new_name_movie, pos)
-    bot.send_message(
-        message.chat.id,
-        f'{file_name.capitalize().replace("_", " ")} #{pos} editada:   {new_name_movie}',
-    )
-    data.clear()
+    try:
+        ft.edit(file, new_name_movie, pos)
+    except IndexError:  # The list shrank since the number was asked
+        OUTBOX.send_message(message.chat.id, f"Error: la película {pos} no existe.")
+    else:
+        OUTBOX.send_message(
+            message.chat.id,
+            f'{file_name.capitalize().replace("_", " ")} #{pos} editada:   {new_name_movie}',
+        )
+    STATE.finish(message.chat.id)
 
 
 # """COMMAND: DEL"""
 
 
 @bot.message_handler(are_nenes=True, commands=["del"])
+@timed("handler")
 def del_command(message):
     """Command del for any movie/serie"""
     file = get_file(message)
-    data[message.chat.id] = {}  # Dict of dicts of ID. Every person in different dict
-    data[message.chat.id]["command"] = "del"
+    STATE.start(message.chat.id, "del")
 
     if file is None:  # Controlling commands with buttons
-        response = buttons_ask_file(message)
-        bot.register_next_step_handler(response, del_ask_name)
+        buttons_ask_file(message)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, del_ask_name)
     else:
-        file_name = ft.which_file(file)
-        req = message.text.split()
+        deleted_message(message.chat.id, file, message.text.split()[2])
+
 
-        if req[2].isdigit():  # Argument 'number'
-            pos = int(req[2])
-            length = ft.len_(file)
+def parse_positions(arg: str, length: int) -> list:
+    """Return the sorted positions of an argument like '3-7,12', None if it is
+    not valid or goes past 'length'. That length only bounds the ranges built
+    here, the store checks again that the positions exist when deleting them"""
+    if not POSITIONS.fullmatch(arg):
+        return None
+    positions = set()
+    for part in arg.split(","):
+        first, _, last = part.partition("-")
+        first, last = int(first), int(last or first)
+        if first < 1 or first > last or last > length:
+            return None
+        positions.update(range(first, last + 1))
+    return sorted(positions)
 
-            if pos < 1 or pos > length:
-                bot.send_message(
-                    message.chat.id,
-                    f'Error: {file_name.capitalize().replace("_", " ")} #{pos} no existe.',
-                )
-                return 1
 
-            movie = ft.find_pos(file, pos)
-            ft.del_(file, pos)
+def deleted_message(chatid, file, arg, **kwargs):
+    """Delete the positions of the argument (or the last one) and send one confirmation"""
+    file_name = ft.which_file(file).capitalize().replace("_", " ")
 
-        else:  # Argument '-last'
-            pos = ft.len_(file)
-            movie = ft.find_pos(file, pos)
-            ft.del_last(file)
+    try:
+        if arg == "-last":
+            movies = [ft.del_last(file)]
+        else:
+            positions = parse_positions(arg, ft.len_(file))
+            if positions is None:
+                raise IndexError(f"invalid positions {arg}")
+            movies = ft.del_many(file, positions)
+    except IndexError:  # Checked in the write batch, so nothing was deleted
+        OUTBOX.send_message(chatid, f"Error: {file_name} #{arg} no existe.", **kwargs)
+        return 1
 
-        bot.send_message(
-            message.chat.id,
-            f'{file_name.capitalize().replace("_", " ")} #{movie[0]} borrada:   {movie[1]}',
-        )
+    OUTBOX.send_message(
+        chatid,
+        "".join(f"{file_name} #{pos} borrada:   {movie}" for pos, movie in movies),
+        **kwargs,
+    )
 
 
+@timed("handler")
 def del_ask_name(message):
     """Step to control number of movie/serie to delete"""
+    if expired(message):
+        return
     file = []
     file.append(message.text.lower())
     file = check_file(file)
-    data[message.chat.id]["file"] = file
+    STATE.set(message.chat.id, "file", file)
 
     if file is None:
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             "Ese fichero no existe, pecador de la pradera!!",
             reply_markup=ReplyKeyboardRemove(),
@@ -546,58 +716,40 @@ def del_ask_name(message):
         file_button = ReplyKeyboardMarkup(
             one_time_keyboard=True,
             input_field_placeholder=(
-                "Escribe un númer de peli/serie a borrar o pulsa el botón para borrar último"
+                "Escribe números (3-7,12) de peli/serie a borrar o pulsa el botón para borrar último"
             ),
             resize_keyboard=True,
         )
         file_button.add("-last", row_width=1)
 
-        msg = bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
-            "Escribe un númer de peli/serie a borrar o pulsa el botón para borrar último:",
+            "Escribe números (3-7,12) de peli/serie a borrar o pulsa el botón para borrar último:",
             reply_markup=file_button,
         )
-        bot.register_next_step_handler(msg, handler_del)
+        bot.register_next_step_handler_by_chat_id(message.chat.id, handler_del)
 
 
+@timed("handler")
 def handler_del(message):
     """Last step to handle del with buttons"""
-    file = data[message.chat.id]["file"]
-    file_name = ft.which_file(file)
-    param_movie = message.text
+    if expired(message):
+        return
+    file = STATE.get(message.chat.id, "file")
+    param_movie = message.text.strip()
 
-    if not param_movie.isdigit() and param_movie != "-last":  # Handle bad arguments
-        bot.send_message(
+    # Handle bad arguments
+    if not POSITIONS.fullmatch(param_movie) and param_movie != "-last":
+        OUTBOX.send_message(
             message.chat.id,
             "Error: no me has puesto un número o argumento '-last', perraca!",
             reply_markup=ReplyKeyboardRemove(),
         )
         return 1
 
-    if param_movie.isdigit():  # Argument 'number'
-        num_movie = int(param_movie)
-        length = ft.len_(file)
-
-        if num_movie < 1 or num_movie > length:
-            bot.send_message(
-                message.chat.id,
-                f'Error: {file_name.capitalize().replace("_", " ")} #{num_movie} no existe.',
-                reply_markup=ReplyKeyboardRemove(),
-            )
-            return 1
-
-        movie = ft.find_pos(file, num_movie)
-        ft.del_(file, num_movie)
-
-    else:  # Argument '-last'
-        num_movie = ft.len_(file)
-        movie = ft.find_pos(file, num_movie)
-        ft.del_last(file)
-
-    bot.send_message(
-        message.chat.id,
-        f'{file_name.capitalize().replace("_", " ")} #{movie[0]} borrada:   {movie[1]}',
-        reply_markup=ReplyKeyboardRemove(),
+    STATE.finish(message.chat.id)
+    return deleted_message(
+        message.chat.id, file, param_movie, reply_markup=ReplyKeyboardRemove()
     )
 
 
@@ -643,58 +795,39 @@ def check_film_arguments(req: list) -> dict:
 
 
 @bot.message_handler(are_nenes=True, commands=["film"])
+@timed("handler")
 def film(message):
     """Command film for searching a movie in FilmAffinity"""
     req = message.text.split()
     if not req[1:]:
         response = helpfilm()
-        bot.send_message(message.chat.id, response, parse_mode="html")
+        OUTBOX.send_message(message.chat.id, response, parse_mode="html")
         return 1
 
     film_args = check_film_arguments(req)
+    dispatch(film_search, message.chat.id, film_args)
 
-    url = FilmAffinity.get_search_url(
-        movie=film_args["movie"],
-        fromyear=film_args["fromyear"],
-        toyear=film_args["toyear"],
-        country=film_args["country"],
-        genre=GENRES[film_args["genre"]] if GENRES.get(film_args["genre"]) else "",
-        orderby=film_args["orderby"],
-    )
 
-    request_url = requests.get(url=url, headers=cf.HEADERS, timeout=10)
-    if request_url.status_code != 200:
-        bot.send_message(
-            message.chat.id,
-            f"Error al buscar: {request_url.status_code} {request_url.reason}",
+@timed("command")
+def film_search(chatid, film_args):
+    """Search in FilmAffinity and show the first page of results"""
+    try:
+        elements_list = FilmAffinity.search(film_args, cf.HEADERS)
+    except requests.HTTPError as error:
+        OUTBOX.send_message(
+            chatid,
+            f"Error al buscar: {error.response.status_code} {error.response.reason}",
         )
-        return 1
-
-    soup = BeautifulSoup(request_url.text, "html.parser")
+        return
 
-    if soup.find("b", text="No se han encontrado coincidencias."):
-        bot.send_message(
-            message.chat.id,
+    if not elements_list:
+        OUTBOX.send_message(
+            chatid,
             f'No se han encontrado resultados. - {film_args["movie"]}? me estás vacilando?',
         )
-        return 1
-
-    elements = soup.find_all("div", class_="mc-title")
-    elements_list = []
-
-    for i, element in enumerate(elements):
-        try:
-            id_ = i + 1
-            year = element.text[-6:].strip().split(")")[0]
-            title = element.find("a").attrs["title"].strip()
-            link = element.find("a").attrs["href"].strip()
+        return
 
-            if [str(id_), year, title, link] in elements_list:
-                continue
-            elements_list.append([str(id_), year, title, link])
-        except IndexError:
-            continue
-    show_page(elements_list, message.chat.id)
+    show_page(elements_list, chatid)
 
 
 def show_page(movie_list, chatid, pag=0, messageid=None):
@@ -728,8 +861,11 @@ def show_page(movie_list, chatid, pag=0, messageid=None):
     markup.add(*choose_buttons)
     markup.row(pre_page_button, close_button, next_page_button)
 
+    # Visible movies and the next page, the ones that will be opened next
+    urls = [item[3] for item in movie_list[start_ : end_ + cf.N_RES_PAG]]
+
     if messageid:
-        bot.edit_message_text(
+        OUTBOX.edit_message_text(
             text_,
             chatid,
             messageid,
@@ -737,51 +873,81 @@ def show_page(movie_list, chatid, pag=0, messageid=None):
             parse_mode="html",
             disable_web_page_preview=True,
         )
+        prefetch(chatid, messageid, urls)
     else:
-        res = bot.send_message(
+
+        def sent(future):
+            """Keep the page once Telegram gives the id of the message"""
+            if future.exception() is None:
+                SESSIONS.put(chatid, future.result().message_id, data_page)
+                prefetch(chatid, future.result().message_id, urls)
+
+        OUTBOX.send_message(
             chatid,
             text_,
             reply_markup=markup,
             parse_mode="html",
             disable_web_page_preview=True,
-        )
-        messageid = res.message_id
-        pickle.dump(data_page, open(f"{cf.DIR['searches']}{chatid}_{messageid}", "wb"))
+        ).add_done_callback(sent)
 
 
 @bot.callback_query_handler(func=lambda x: x.data.startswith("chosen_movie:"))
+@timed("handler")
 def chosen_mov(call):
     """Manage the behaviour of the button to show movie"""
     chatid = call.message.chat.id
     messageid = call.message.id
     id_ = int(call.data.split(":")[1]) - 1
-    data_page = pickle.load(open(f"{cf.DIR['searches']}{chatid}_{messageid}", "rb"))
+    data_page = SESSIONS.get(chatid, messageid)
+    if data_page is None:
+        bot.answer_callback_query(call.id, "Esta búsqueda ha caducado")
+        return
 
     url = data_page["list"][id_][3]
-    mov = FilmAffinity(FilmAffinity.get_soup(page=url, head=cf.HEADERS))
-    bot.send_message(chatid, str(mov), parse_mode="html")
+    dispatch(show_movie, chatid, url)
+
+
+@timed("command")
+def show_movie(chatid, url):
+    """Send the card of a movie"""
+    try:
+        mov = FilmAffinity.get_movie(page=url, head=cf.HEADERS)
+    except requests.HTTPError as error:
+        OUTBOX.send_message(
+            chatid,
+            f"Error al leer la peli: {error.response.status_code} {error.response.reason}",
+        )
+        return
+    except ValueError:
+        OUTBOX.send_message(chatid, "Error al leer la peli: la página no tiene ficha.")
+        return
+    OUTBOX.send_message(chatid, str(mov), parse_mode="html")
 
 
 @bot.callback_query_handler(func=lambda x: True)
+@timed("handler")
 def callback_answer_buttons(call):
     """Manage the behaviour of the buttons"""
     chatid = call.message.chat.id
     messageid = call.message.id
 
     if call.data == "close":
-        bot.delete_message(chatid, messageid)
+        PREFETCHER.cancel(chatid, messageid)
+        SESSIONS.pop(chatid, messageid)
+        OUTBOX.delete_message(chatid, messageid)
         return
 
-    data_page = pickle.load(open(f"{cf.DIR['searches']}{chatid}_{messageid}", "rb"))
+    data_page = SESSIONS.get(chatid, messageid)
+    if data_page is None:
+        bot.answer_callback_query(call.id, "Esta búsqueda ha caducado")
+        return
     if call.data == "pre":
         # si ya estamos en la primera página
         if data_page["pag"] == 0:
             bot.answer_callback_query(call.id, "Ya estás en la primera página")
         else:
             data_page["pag"] -= 1
-            pickle.dump(
-                data_page, open(f"{cf.DIR['searches']}{chatid}_{messageid}", "wb")
-            )
+            SESSIONS.put(chatid, messageid, data_page)
             show_page(data_page["list"], chatid, data_page["pag"], messageid)
         return
     if call.data == "next":
@@ -790,9 +956,7 @@ def callback_answer_buttons(call):
             bot.answer_callback_query(call.id, "Ya estás en la última página")
         else:
             data_page["pag"] += 1
-            pickle.dump(
-                data_page, open(f"{cf.DIR['searches']}{chatid}_{messageid}", "wb")
-            )
+            SESSIONS.put(chatid, messageid, data_page)
             show_page(data_page["list"], chatid, data_page["pag"], messageid)
         return
 
@@ -801,12 +965,13 @@ def callback_answer_buttons(call):
 # Futbol command
 # ***************************************************** """
 @bot.message_handler(are_nenes=True, commands=["futbol", "fútbol"])
+@timed("handler")
 def futbol(message):
     """Command futbol"""
     req = message.text.split()
     if not req[1:]:
         response = helpfutbol()
-        bot.send_message(message.chat.id, response, parse_mode="html")
+        OUTBOX.send_message(message.chat.id, response, parse_mode="html")
         return 1
 
     opt = req[1]
@@ -819,23 +984,27 @@ def futbol(message):
         case "barca":
             pass
         case _:
-            bot.send_message(message.chat.id, "No existe esa opción elegida.")
+            OUTBOX.send_message(message.chat.id, "No existe esa opción elegida.")
 
 
 def futbol_standing(chatid):
     """When chosen option is clasi"""
-    url = Standings.get_search_url()
-    request_url = requests.get(url=url, headers=cf.HEADERS, timeout=10)
-    if request_url.status_code != 200:
-        bot.send_message(
+    dispatch(send_standings, chatid)
+
+
+@timed("command")
+def send_standings(chatid):
+    """Send the standings table"""
+    try:
+        clasi = standings_table(cf.HEADERS)
+    except requests.HTTPError as error:
+        OUTBOX.send_message(
             chatid,
-            f"Error al leer la clasificación: {request_url.status_code} {request_url.reason}",
+            f"Error al leer la clasificación: {error.response.status_code} {error.response.reason}",
         )
-        return 1
-
-    clasi = Standings(Standings.get_soup(page=url, head=cf.HEADERS))
+        return
 
-    bot.send_message(chatid, f"<pre>{clasi}</pre>", parse_mode="html")
+    OUTBOX.send_message(chatid, clasi, parse_mode="html")
 
 
 # """ Methods to control web-server"""
@@ -852,6 +1021,7 @@ def start_web_server():
     """Initiate web-server when running in web"""
     bot.remove_webhook()
     time.sleep(1)
+    bot.threaded = False  # The workers of UPDATES run the handlers, in order per chat
     bot.set_webhook(url=cf.APP_URL)
     serve(
         web_server,
@@ -879,6 +1049,11 @@ def main():
         ]
     )
     bot.add_custom_filter(AreNenes())
+    start_janitor()
+    if cf.STATE["path"] is not None:  # Keep the button flows across restarts
+        handlers = f'{cf.STATE["path"]}.handlers'
+        bot.enable_save_next_step_handlers(delay=2, filename=handlers)
+        bot.load_next_step_handlers(filename=handlers)
 
     if os.environ.get("DYNO_RAM"):
         thread = threading.Thread(
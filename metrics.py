@@ -0,0 +1,158 @@
+"""Timing spans and counters of the hot paths, shown in Prometheus format"""
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import config as cf
+
+PREFIX = "nenes"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+trace_logger = logging.getLogger(f"{__name__}.trace")
+if cf.METRICS["trace"] is not None:  # Opt-in log with the spans of every request
+    _handler = logging.FileHandler(cf.METRICS["trace"], encoding="utf8")
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+_lock = threading.Lock()
+_spans = {}  # (name, labels) -> [bucket counts..., count, sum]
+_counters = {}  # (name, labels) -> value
+_collectors = {}  # prefix -> (function returning a dict of values, keys of counters)
+_current = contextvars.ContextVar("span", default=None)  # Span traced right now
+
+
+class _Node:
+    """Span kept for the trace log"""
+
+    __slots__ = ("name", "labels", "seconds", "children")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.seconds = 0.0
+        self.children = []
+
+    def __str__(self) -> str:
+        labels = ",".join(f"{key}={value}" for key, value in self.labels)
+        text = f"{self.name}[{labels}] {self.seconds * 1000:.1f}ms"
+        if self.children:
+            text += f" ({', '.join(str(child) for child in self.children)})"
+        return text
+
+
+def _observe(name: str, labels: tuple, seconds: float):
+    """Add a duration to the histogram of a span"""
+    with _lock:
+        values = _spans.get((name, labels))
+        if values is None:
+            values = _spans[(name, labels)] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += 1
+        values[-1] += seconds
+
+
+@contextmanager
+def span(name: str, **labels):
+    """Time a block, nested in the span running when it starts"""
+    if not cf.METRICS["enabled"]:
+        yield
+        return
+    labels = tuple(sorted((key, str(value)) for key, value in labels.items()))
+    node = token = None
+    if trace_logger.isEnabledFor(logging.INFO):
+        node = _Node(name, labels)
+        parent = _current.get()
+        token = _current.set(node)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _observe(name, labels, seconds)
+        if node is not None:
+            _current.reset(token)
+            node.seconds = seconds
+            if parent is None:
+                trace_logger.info("%s", node)
+            else:
+                parent.children.append(node)
+
+
+def timed(name: str):
+    """Decorator that times every call of a function"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def a_wrapper(*args, **kwargs):
+            with span(name, func=func.__name__):
+                return func(*args, **kwargs)
+
+        return a_wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1, **labels):
+    """Add to a counter"""
+    if not cf.METRICS["enabled"]:
+        return
+    key = (name, tuple(sorted((key, str(label)) for key, label in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def collect(prefix: str, function, counters=()):
+    """Show the dict returned by 'function' when rendering, as counters the
+    keys in 'counters' (values that only grow) and as gauges the rest"""
+    _collectors[prefix] = (function, frozenset(counters))
+
+
+def _labels(labels: tuple) -> str:
+    """Return the labels of a line in the Prometheus text format"""
+    if not labels:
+        return ""
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def render() -> str:
+    """Return every metric in the Prometheus text format"""
+    with _lock:
+        spans = {key: list(values) for key, values in _spans.items()}
+        counters = dict(_counters)
+
+    lines = [f"# TYPE {PREFIX}_span_seconds histogram"]
+    for (name, labels), values in sorted(spans.items()):
+        labels = (("span", name),) + labels
+        for bound, hits in zip(BUCKETS + ("+Inf",), values):
+            le_labels = _labels(labels + (("le", str(bound)),))
+            lines.append(f"{PREFIX}_span_seconds_bucket{le_labels} {hits}")
+        lines.append(f"{PREFIX}_span_seconds_sum{_labels(labels)} {values[-1]}")
+        lines.append(f"{PREFIX}_span_seconds_count{_labels(labels)} {values[-2]}")
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            typed.add(name)
+        lines.append(f"{PREFIX}_{name}_total{_labels(labels)} {value}")
+
+    for prefix, (function, counter_keys) in sorted(_collectors.items()):
+        for key, value in sorted(function().items()):
+            if key in counter_keys:
+                name, kind = f"{PREFIX}_{prefix}_{key}_total", "counter"
+            else:
+                name, kind = f"{PREFIX}_{prefix}_{key}", "gauge"
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,240 @@
+"""Queue for the messages sent to Telegram, with the rate limits of its API"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+from futures import log_error
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allow 'rate' calls per second with bursts of up to 'burst' calls"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        """Add the tokens earned since the last call"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Return the seconds until there is a token, 0 if there is one now"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Spend a token"""
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        """Tell if the bucket has refilled, so it can be forgotten"""
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Job:
+    """A call to the bot waiting in the queue"""
+
+    __slots__ = ("method", "chatid", "args", "kwargs", "key", "future")
+
+    def __init__(self, method, chatid, args, kwargs, key=None):
+        self.method = method
+        self.chatid = chatid
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key  # (chatid, messageid) of the edits
+        self.future = Future()
+
+
+class Outbox:
+    """Calls to Telegram that send, edit or delete messages, sent in the background.
+
+    Every call returns a Future at once. A pool of workers sends them keeping
+    a token bucket for each chat and a global one, and the calls of a chat
+    go out in order. Private chats (positive id) get a faster bucket than
+    groups, as Telegram allows. An edit of a message that already has one
+    waiting replaces it, and a 429 holds the chat for the retry_after asked.
+    """
+
+    def __init__(
+        self, bot, rate, chat_rate, group_rate, chat_burst, workers, enabled=True
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.enabled = enabled  # If False the calls are sent right away
+        self.stats = {"sent": 0, "coalesced": 0, "limited": 0}
+        self._global = TokenBucket(rate, rate)
+        self._buckets = {}  # chatid -> TokenBucket
+        self._chats = {}  # chatid -> deque of jobs, while it has jobs or one in flight
+        self._ready = []  # heap of (time, seq, chatid) of chats with a job to send
+        self._edits = {}  # (chatid, messageid) -> edit waiting in the queue
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+
+    def send_message(self, chat_id, text, **kwargs) -> Future:
+        """Queue bot.send_message"""
+        return self._queue(_Job("send_message", chat_id, (chat_id, text), kwargs))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs) -> Future:
+        """Queue bot.edit_message_text, replacing the edit waiting for that message"""
+        key = (chat_id, message_id)
+        with self._cond:
+            job = self._edits.get(key)
+            if job is not None:
+                job.args = (text, chat_id, message_id)
+                job.kwargs = kwargs
+                self.stats["coalesced"] += 1
+                return job.future
+        return self._queue(
+            _Job("edit_message_text", chat_id, (text, chat_id, message_id), kwargs, key)
+        )
+
+    def delete_message(self, chat_id, message_id, **kwargs) -> Future:
+        """Queue bot.delete_message, dropping the edit waiting for that message"""
+        with self._cond:
+            job = self._edits.pop((chat_id, message_id), None)
+            if job is not None:
+                self._chats[chat_id].remove(job)
+                job.future.set_result(None)
+        return self._queue(
+            _Job("delete_message", chat_id, (chat_id, message_id), kwargs)
+        )
+
+    def _queue(self, job: _Job) -> Future:
+        """Put a job at the end of the queue of its chat"""
+        job.future.add_done_callback(log_error("Telegram call"))
+        if not self.enabled:
+            self._call(job)
+            return job.future
+
+        self._start()
+        with self._cond:
+            jobs = self._chats.get(job.chatid)
+            if jobs is None:
+                jobs = self._chats[job.chatid] = deque()
+                self._schedule(job.chatid, time.monotonic())
+            jobs.append(job)
+            if job.key is not None:
+                self._edits[job.key] = job
+        return job.future
+
+    def _start(self):
+        """Start the workers the first time"""
+        with self._cond:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="outbox"
+                )
+                threading.Thread(
+                    name="outbox_thread", target=self._dispatch, daemon=True
+                ).start()
+
+    def _schedule(self, chatid, when: float):
+        """Mark a chat as ready to send its next job at 'when'"""
+        heapq.heappush(self._ready, (when, next(self._seq), chatid))
+        self._cond.notify()
+
+    def _bucket(self, chatid) -> TokenBucket:
+        """Return the bucket of a chat"""
+        bucket = self._buckets.get(chatid)
+        if bucket is None:
+            rate = self.chat_rate if chatid > 0 else self.group_rate
+            bucket = self._buckets[chatid] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _next_job(self) -> _Job:
+        """Wait until a chat is ready and both buckets have a token"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                when, _, chatid = self._ready[0]
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                wait = self._bucket(chatid).delay(now)
+                if wait:
+                    heapq.heapreplace(self._ready, (now + wait, next(self._seq), chatid))
+                    continue
+                wait = self._global.delay(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+
+                heapq.heappop(self._ready)
+                jobs = self._chats[chatid]
+                if not jobs:  # Its only job was an edit dropped by a delete
+                    del self._chats[chatid]
+                    continue
+                self._bucket(chatid).take()
+                self._global.take()
+                job = jobs.popleft()
+                if job.key is not None:
+                    self._edits.pop(job.key, None)
+                return job
+
+    def _dispatch(self):
+        """Hand the jobs to the workers as the limits allow"""
+        while True:
+            self._executor.submit(self._send, self._next_job())
+
+    def _call(self, job: _Job):
+        """Call the bot and resolve the future of the job"""
+        try:
+            with span("telegram", method=job.method):
+                result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+            job.future.set_result(result)
+        except Exception as error:  # pylint: disable=broad-except
+            job.future.set_exception(error)
+
+    def _send(self, job: _Job):
+        """Send a job and schedule the next one of its chat"""
+        hold = 0
+        try:
+            with span("telegram", method=job.method):
+                result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except ApiTelegramException as error:
+            if error.error_code != 429:
+                job.future.set_exception(error)
+            else:
+                hold = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+                logger.warning("Chat %s limited by Telegram for %ss", job.chatid, hold)
+        except Exception as error:  # pylint: disable=broad-except
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+        with self._cond:
+            now = time.monotonic()
+            jobs = self._chats[job.chatid]
+            if hold:  # Back to the front of the queue, to send again after waiting
+                self.stats["limited"] += 1
+                jobs.appendleft(job)
+                if job.key is not None:
+                    self._edits.setdefault(job.key, job)
+            else:
+                self.stats["sent"] += 1
+            if jobs:
+                self._schedule(job.chatid, now + hold)
+            else:
+                del self._chats[job.chatid]
+                if self._bucket(job.chatid).full(now):
+                    del self._buckets[job.chatid]
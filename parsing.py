@@ -0,0 +1,54 @@
+"""HTML parsing with the fastest backend available"""
+import importlib.util
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+import config as cf
+from metrics import span
+
+BACKENDS = ("lxml", "html.parser")  # Fastest first, html.parser always works
+
+
+def available_backends() -> list:
+    """Return the backends that can be used here"""
+    return [
+        backend
+        for backend in BACKENDS
+        if backend == "html.parser" or importlib.util.find_spec(backend) is not None
+    ]
+
+
+def _backend() -> str:
+    """Return the backend set in config, the fastest one if it is 'auto'"""
+    if cf.HTML_PARSER == "auto":
+        return available_backends()[0]
+    return cf.HTML_PARSER
+
+
+def _classes(attrs) -> list:
+    """Return the classes of a tag before BeautifulSoup splits them"""
+    classes = dict(attrs).get("class") or []
+    return classes.split() if isinstance(classes, str) else classes
+
+
+def _movie_parts(name, attrs) -> bool:
+    """Match the tags read by filmaffinity.parse_movie"""
+    attrs = dict(attrs)
+    return (
+        (name == "h1" and attrs.get("id") == "main-title")
+        or (name == "div" and attrs.get("id") == "movie-rat-avg")
+        or (name == "dl" and "movie-info" in _classes(attrs))
+    )
+
+
+RESULTS = SoupStrainer("div", class_="mc-title")  # Results of a search
+MOVIE = SoupStrainer(_movie_parts)  # Page of a movie
+STANDINGS = SoupStrainer("table")  # Standings page
+
+PARSER = _backend()
+
+
+def make_soup(markup: str, only: SoupStrainer = None, parser: str = None) -> BeautifulSoup:
+    """Parse a page, only the parts matched by 'only' if given"""
+    with span("parse", parser=parser or PARSER, partial=only is not None):
+        return BeautifulSoup(markup, parser or PARSER, parse_only=only)
@@ -0,0 +1,50 @@
+"""Thread pool for the commands that scrape the web"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config as cf
+from futures import log_error
+
+
+class Pipeline:
+    """Bounded pool of threads where slow commands run outside the bot workers.
+
+    A command holds one of its threads from start to end, also while it waits
+    for FilmAffinity, so at most 'workers' commands run at the same time and
+    the rest wait in the queue of the pool. Scraping uses requests, which has
+    no non-blocking mode, so waiting without a thread would need an async
+    HTTP client and async handlers.
+    """
+
+    def __init__(self, workers: int, name: str = "pipeline"):
+        self.workers = workers
+        self.name = name
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Return the pool, starting it the first time"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix=self.name
+                )
+            return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule a call and return its concurrent.futures.Future"""
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(log_error("Command"))
+        return future
+
+
+PIPELINE = Pipeline(cf.PIPELINE_WORKERS)
+
+
+def dispatch(func, *args, **kwargs):
+    """Run a command in the pipeline, waiting for it if the async mode is off"""
+    future = PIPELINE.submit(func, *args, **kwargs)
+    if not cf.ASYNC_COMMANDS:
+        future.result()
+    return future
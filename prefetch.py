@@ -0,0 +1,101 @@
+"""Background download of the movies a user is about to open"""
+import logging
+import threading
+import time
+
+import requests
+
+import config as cf
+import httpclient
+from filmaffinity import FilmAffinity
+from pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Download movie pages in a pool of their own so they are cached before the tap.
+
+    Downloads are grouped by the message showing them, so closing the message
+    cancels whatever has not started. At most 'workers' run at the same time.
+    Failed downloads are not cached or retried, and a 429 stops prefetching for
+    a while, doubling the pause while FilmAffinity keeps throttling. Downloads
+    use the background slots of httpclient, so they never delay user commands.
+    """
+
+    def __init__(self, workers: int, backoff: float, max_backoff: float):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._pause = 0  # Seconds of the last pause, 0 if the last download worked
+        self._paused_until = 0.0
+        self._pipeline = Pipeline(workers, "prefetch")
+        self._futures = {}  # (chatid, messageid) -> futures of its downloads
+        self._lock = threading.Lock()
+
+    def prefetch(self, chatid, messageid, urls):
+        """Start downloading the movies of a message"""
+        if self.paused():
+            return
+        key = (chatid, messageid)
+        for url in urls:
+            future = self._pipeline.submit(self._fetch, url)
+            with self._lock:
+                self._futures.setdefault(key, set()).add(future)
+            future.add_done_callback(lambda done, key=key: self._done(key, done))
+
+    def cancel(self, chatid, messageid):
+        """Cancel the downloads of a message"""
+        with self._lock:
+            futures = self._futures.pop((chatid, messageid), ())
+        for future in futures:
+            future.cancel()
+
+    def _done(self, key, future):
+        """Forget a finished download"""
+        with self._lock:
+            futures = self._futures.get(key)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._futures[key]
+
+    def paused(self) -> bool:
+        """Tell if prefetching is paused after a 429"""
+        return time.monotonic() < self._paused_until
+
+    def _throttled(self, response: requests.Response):
+        """Pause prefetching for the Retry-After asked or the next backoff"""
+        if self.paused():  # Another download in flight already paused it
+            return
+        self._pause = min(max(self._pause * 2, self.backoff), self.max_backoff)
+        retry_after = response.headers.get("Retry-After", "")
+        pause = int(retry_after) if retry_after.isdigit() else self._pause
+        self._paused_until = time.monotonic() + pause
+        logger.warning("FilmAffinity throttled, no prefetching for %ss", pause)
+
+    def _fetch(self, url):
+        """Download and cache one movie"""
+        if self.paused():
+            return
+        try:
+            with httpclient.background():
+                FilmAffinity.get_movie(page=url, head=cf.HEADERS)
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 429:
+                self._throttled(error.response)
+            logger.debug("Prefetch of %s failed", url, exc_info=True)
+        except Exception:  # pylint: disable=broad-except
+            logger.debug("Prefetch of %s failed", url, exc_info=True)
+        else:
+            self._pause = 0
+
+
+PREFETCHER = Prefetcher(
+    cf.PREFETCH["workers"], cf.PREFETCH["backoff"], cf.PREFETCH["max_backoff"]
+)
+
+
+def prefetch(chatid, messageid, urls):
+    """Prefetch the movies of a message if it is enabled"""
+    if cf.PREFETCH["enabled"]:
+        PREFETCHER.prefetch(chatid, messageid, urls)
@@ -0,0 +1,147 @@
+"""In-memory inverted index for searching titles"""
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left, insort
+
+WORD = re.compile(r"\w+")
+
+
+def normalize(text: str) -> str:
+    """Return the text without accents and in lower case"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text: str) -> list:
+    """Return the normalized words of a text"""
+    return WORD.findall(normalize(text))
+
+
+def trigrams(text: str) -> set:
+    """Return the trigrams of every word of a text, padded as '  word '"""
+    grams = set()
+    for word in tokenize(text):
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class SearchIndex:
+    """Index of the titles of a list by word.
+
+    Documents are the row ids of the store, kept sorted so the position of a
+    document is its place in 'ids'. Every word of the query has to match the
+    beginning of some word of the title.
+    """
+
+    def __init__(self, stamp=None):
+        self.stamp = stamp
+        self.ids = []  # Sorted row ids, position = index + 1
+        self._titles = {}  # id -> title
+        self._postings = {}  # word -> set of ids
+        self._words = []  # Sorted vocabulary for prefix search
+        self._grams = {}  # id -> trigrams of the title
+        self._gram_postings = {}  # trigram -> set of ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id_: int, title: str):
+        """Add a title to the index"""
+        if not self.ids or id_ > self.ids[-1]:
+            self.ids.append(id_)
+        else:
+            insort(self.ids, id_)
+        self._titles[id_] = title
+        for word in set(tokenize(title)):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                insort(self._words, word)
+            postings.add(id_)
+        grams = self._grams[id_] = trigrams(title)
+        for gram in grams:
+            self._gram_postings.setdefault(gram, set()).add(id_)
+
+    def remove(self, id_: int):
+        """Remove a title from the index"""
+        title = self._titles.pop(id_)
+        self.ids.pop(bisect_left(self.ids, id_))
+        for word in set(tokenize(title)):
+            postings = self._postings[word]
+            postings.discard(id_)
+            if not postings:
+                del self._postings[word]
+                self._words.pop(bisect_left(self._words, word))
+        for gram in self._grams.pop(id_):
+            postings = self._gram_postings[gram]
+            postings.discard(id_)
+            if not postings:
+                del self._gram_postings[gram]
+
+    def update(self, id_: int, title: str):
+        """Change the title of a document"""
+        self.remove(id_)
+        self.add(id_, title)
+
+    def id_at(self, pos: int) -> int:
+        """Return the id of the document in the position 'pos' (starting at 1)"""
+        if pos < 1 or pos > len(self.ids):
+            raise IndexError(f"position {pos} out of range")
+        return self.ids[pos - 1]
+
+    def position(self, id_: int) -> int:
+        """Return the position of a document"""
+        return bisect_left(self.ids, id_) + 1
+
+    def title(self, id_: int) -> str:
+        """Return the title of a document"""
+        return self._titles[id_]
+
+    def _prefixed(self, prefix: str) -> set:
+        """Return the ids of the titles with a word starting with 'prefix'"""
+        found = set()
+        i = bisect_left(self._words, prefix)
+        while i < len(self._words) and self._words[i].startswith(prefix):
+            found |= self._postings[self._words[i]]
+            i += 1
+        return found
+
+    def search(self, query: str) -> list:
+        """Return the (position, title) of the titles matching every word"""
+        words = tokenize(query)
+        if not words:
+            return []
+        found = None
+        for word in sorted(words, key=len, reverse=True):  # Longest are rarest
+            matches = self._prefixed(word)
+            found = matches if found is None else found & matches
+            if not found:
+                return []
+        return [(self.position(id_), self._titles[id_]) for id_ in sorted(found)]
+
+    def fuzzy_search(self, query: str, limit: int, min_score: float = 0.3) -> list:
+        """Return up to 'limit' (score, position, title) ordered by similarity.
+
+        The score is the share of the trigrams of the query found in the title,
+        so a query contained in a longer title ("padrino" in "El Padrino") scores
+        as high as an exact match and a typo only loses a few trigrams.
+        """
+        grams = trigrams(query)
+        if not grams:
+            return []
+        shared = {}
+        for gram in grams:
+            for id_ in self._gram_postings.get(gram, ()):
+                shared[id_] = shared.get(id_, 0) + 1
+        scored = []
+        for id_, hits in shared.items():
+            score = hits / len(grams)
+            if score >= min_score:
+                # Ties go to the title with less extra words
+                scored.append((score, -len(self._grams[id_]), id_))
+        return [
+            (round(score, 2), self.position(id_), self._titles[id_])
+            for score, _, id_ in heapq.nlargest(limit, scored)
+        ]
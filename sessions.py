@@ -0,0 +1,107 @@
+"""Store for the pagination state of the /film result messages"""
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+
+import config as cf
+from cache import DiskCache, LRUCache
+
+OLD_SESSION = re.compile(r"-?\d+_\d+")  # Pickle files named {chatid}_{messageid}
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """Sessions live in memory and expire on their own.
+
+    When the memory is full the least recently used sessions are spilled to a
+    single SQLite file (if 'spill' is given) and come back on their next tap.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, spill: str = None, spill_entries: int = 0):
+        self.spill = None if spill is None else DiskCache(spill, ttl, spill_entries)
+        self.memory = LRUCache(
+            max_entries, ttl, on_evict=None if spill is None else self.spill.put
+        )
+
+    @staticmethod
+    def key(chatid, messageid) -> str:
+        """Return the key of the session of a message"""
+        return f"{chatid}_{messageid}"
+
+    def get(self, chatid, messageid) -> dict:
+        """Return the session of a message, None if it has expired"""
+        key = self.key(chatid, messageid)
+        session = self.memory.get(key)
+        if session is None and self.spill is not None:
+            session = self.spill.get(key)
+            if session is not None:
+                self.spill.delete(key)
+                self.memory.put(key, session)
+        return session
+
+    def put(self, chatid, messageid, session: dict):
+        """Save the session of a message"""
+        self.memory.put(self.key(chatid, messageid), session)
+
+    def pop(self, chatid, messageid):
+        """Forget the session of a message"""
+        key = self.key(chatid, messageid)
+        self.memory.pop(key)
+        if self.spill is not None:
+            self.spill.delete(key)
+
+    def collect_garbage(self, directory: str, max_age: float) -> dict:
+        """Clean the searches directory and return what was reclaimed.
+
+        The old per-message pickle files younger than 'max_age' are packed into
+        the spill file and every one of them is removed. Then the spill file
+        drops its expired entries and those over its size budget.
+        """
+        report = {"files": 0, "bytes": 0, "packed": 0}
+        now = time.time()
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not OLD_SESSION.fullmatch(entry.name):
+                continue
+            stat = entry.stat()
+            if self.spill is not None and now - stat.st_mtime < max_age:
+                try:
+                    with open(entry.path, "rb") as old:
+                        self.spill.put(entry.name, pickle.load(old))
+                    report["packed"] += 1
+                except (OSError, pickle.UnpicklingError, EOFError):
+                    pass
+            os.remove(entry.path)
+            report["files"] += 1
+            report["bytes"] += stat.st_size
+
+        if self.spill is not None:
+            report["bytes"] += self.spill.purge()
+        return report
+
+
+SESSIONS = SessionStore(**cf.SESSIONS)
+
+
+def janitor():
+    """Collect the garbage of the searches directory every cf.JANITOR_INTERVAL"""
+    while True:
+        try:
+            report = SESSIONS.collect_garbage(cf.DIR["searches"], cf.SESSIONS["ttl"])
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Searches cleaning failed, trying again later")
+        else:
+            logger.info(
+                "Searches cleaned: %(files)s files and %(bytes)s bytes reclaimed, "
+                "%(packed)s sessions packed",
+                report,
+            )
+        time.sleep(cf.JANITOR_INTERVAL)
+
+
+def start_janitor():
+    """Start the janitor in the background"""
+    threading.Thread(name="janitor_thread", target=janitor, daemon=True).start()
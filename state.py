@@ -0,0 +1,63 @@
+"""Conversation state of every chat for the commands asked with buttons"""
+import json
+import os
+import threading
+import time
+
+
+class ChatState:
+    """State of the conversation of each chat.
+
+    Every chat has its own dict, so finishing a conversation only forgets
+    that chat. A conversation expires 'ttl' seconds after its last change.
+    If 'path' is given the states are saved there, so they survive a restart.
+    """
+
+    def __init__(self, ttl: float, path: str = None):
+        self.ttl = ttl
+        self.path = path
+        self._chats = {}  # chatid -> [expires, state]
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf8") as saved:
+                self._chats = {int(chatid): entry for chatid, entry in json.load(saved).items()}
+
+    def start(self, chatid, command: str):
+        """Start a new conversation for a chat"""
+        with self._lock:
+            now = time.time()
+            for old in [chat for chat, entry in self._chats.items() if entry[0] < now]:
+                del self._chats[old]
+            self._chats[chatid] = [now + self.ttl, {"command": command}]
+            self._save()
+
+    def get(self, chatid, key: str, default=None):
+        """Return a value of the conversation of a chat"""
+        with self._lock:
+            entry = self._chats.get(chatid)
+            if entry is None or entry[0] < time.time():
+                return default
+            return entry[1].get(key, default)
+
+    def set(self, chatid, key: str, value):
+        """Save a value in the conversation of a chat"""
+        with self._lock:
+            entry = self._chats.setdefault(chatid, [0, {}])
+            entry[0] = time.time() + self.ttl
+            entry[1][key] = value
+            self._save()
+
+    def finish(self, chatid):
+        """Forget the conversation of a chat"""
+        with self._lock:
+            if self._chats.pop(chatid, None) is not None:
+                self._save()
+
+    def _save(self):
+        """Write the states to disk if there is a path, replacing the file atomically"""
+        if self.path is None:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf8") as saved:
+            json.dump(self._chats, saved)
+        os.replace(tmp, self.path)